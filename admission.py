@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from custom_logger import logger
+
+MAX_IN_FLIGHT = 2               # Requests run concurrently (per model)
+MAX_QUEUE = 16                  # Requests waiting for a slot, above it new requests are rejected
+QUEUE_TIMEOUT_SECONDS = 60      # A request waiting longer is rejected
+DEFAULT_RUN_SECONDS = 30        # Run duration assumed before any run has completed (for Retry-After)
+WAIT_SAMPLES = 256              # Recent queue wait times kept for the percentiles
+
+
+class AdmissionRejected(Exception):
+    """The request can't be admitted now - the client should retry after 'retry_after' seconds"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket():
+    """A slot held by an admitted request. Releasing it more than once is harmless."""
+
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionController():
+    """Admission control of the requests sent to one model.
+
+       At most 'max_in_flight' requests run at once, the others wait in a bounded priority queue (lower priority value
+       first, FIFO within the same priority). A request is rejected when the queue is full or when it waited more than
+       'queue_timeout_seconds' - with an estimation of when to retry, based on the queue depth and the run durations.
+    """
+
+    def __init__(self, name: str, max_in_flight: int = MAX_IN_FLIGHT, max_queue: int = MAX_QUEUE,
+                 queue_timeout_seconds: float = QUEUE_TIMEOUT_SECONDS):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+
+        self.in_flight = 0
+        self.waiters = []  # Heap of (priority, sequence, future)
+        self.sequence = itertools.count()
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.completed = 0
+        self.average_run_seconds = None  # Exponential moving average
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    def retry_after(self) -> int:
+        run_seconds = self.average_run_seconds or DEFAULT_RUN_SECONDS
+        return max(1, math.ceil((len(self.waiters) + 1) / self.max_in_flight * run_seconds))
+
+    async def acquire(self, priority: int = 0) -> AdmissionTicket:
+        """Wait for a slot. Raises AdmissionRejected when the queue is full or the wait times out."""
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            return self.admit(0.0)
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"Model '{self.name}' is busy ({len(self.waiters)} requests queued)", self.retry_after())
+
+        queued_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.sequence), future)
+        heapq.heappush(self.waiters, entry)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout_seconds)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                self.release_slot()  # The slot was handed over just as the wait ended - pass it on
+            elif entry in self.waiters:  # Not already popped (and skipped) by a release since the wait ended
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise AdmissionRejected(f"Model '{self.name}' is busy (waited {self.queue_timeout_seconds}s)",
+                                        self.retry_after()) from None
+            raise
+
+        # The slot of a completed request was handed over (in_flight unchanged)
+        return self.admit(time.monotonic() - queued_at)
+
+    def admit(self, waited: float) -> AdmissionTicket:
+        self.admitted += 1
+        self.waits.append(waited)
+        if waited:
+            logger.debug(f"Request admitted to model '{self.name}' after waiting {waited:.2f}s")
+        return AdmissionTicket(self)
+
+    def release(self, run_seconds: float):
+        self.completed += 1
+        self.average_run_seconds = (run_seconds if self.average_run_seconds is None
+                                    else 0.8 * self.average_run_seconds + 0.2 * run_seconds)
+        self.release_slot()
+
+    def release_slot(self):
+        """Hand the slot over to the next waiting request, or free it"""
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        ticket = await self.acquire(priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        percentile = lambda p: round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else 0.0
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": len(self.waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "completed": self.completed,
+            "queue_wait_seconds": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+            "average_run_seconds": round(self.average_run_seconds or 0.0, 3),
+        }
+
+
+async def check_release_after_cancelled_wait():
+    """Regression check - a slot released after a waiter's future was cancelled (timeout or task cancellation),
+       but before the waiter resumed"""
+    controller = AdmissionController("check", max_in_flight=1)
+    holder = await controller.acquire()
+
+    waiter = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    controller.waiters[0][2].cancel()  # As done by wait_for on cancellation or timeout
+    holder.release()  # Pops (and skips) the cancelled waiter before it resumes
+    try:
+        await waiter
+        raise AssertionError("The waiter should have been cancelled")
+    except asyncio.CancelledError:
+        pass
+    assert controller.in_flight == 0 and not controller.waiters, controller.stats()
+
+    controller = AdmissionController("check", max_in_flight=1, queue_timeout_seconds=0.05)
+    holder = await controller.acquire()
+    waiter = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0.1)
+    holder.release()
+    try:
+        (await waiter).release()  # The slot may be handed over just as the wait ends
+    except AdmissionRejected as e:
+        assert e.retry_after >= 1
+    assert controller.in_flight == 0 and not controller.waiters, controller.stats()
+    print("Admission checks passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(check_release_after_cancelled_wait())
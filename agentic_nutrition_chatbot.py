@@ -8,30 +8,148 @@ from urllib import response
 #from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_agentchat.base import TaskResult
 from autogen_core.models import ModelFamily #, ModelInfo
-from autogen_agentchat.messages import TextMessage
+from autogen_agentchat.messages import TextMessage, ModelClientStreamingChunkEvent, ToolCallRequestEvent
 from autogen_core import CancellationToken
-from autogen_core.models import ChatCompletionClient
+from autogen_core.models import ChatCompletionClient, UserMessage, AssistantMessage
+from autogen_core.model_context import ChatCompletionContext
 from autogen_ext.models.ollama import OllamaChatCompletionClient 
 from autogen_agentchat.agents import AssistantAgent, UserProxyAgent 
 from autogen_agentchat.conditions import TextMentionTermination 
 from autogen_agentchat.teams import RoundRobinGroupChat 
-from autogen_ext.tools.mcp import StdioServerParams, mcp_server_tools
 from autogen_agentchat.ui import Console 
 from markdown_streamer import MarkdownStreamer
+from mcp_pool import McpServerPool
+from admission import AdmissionController
+from token_budget_context import TokenBudgetChatCompletionContext, count_tokens
 from custom_logger import logger
 from enum import Enum
+from collections import OrderedDict
 import textwrap
+import time
+
+MAX_SESSIONS_PER_MODEL = 64           # Conversations kept in memory per model (least recently used are evicted)
+SESSION_IDLE_TTL_SECONDS = 2 * 3600   # Conversations idle for longer are evicted
+MAX_CONCURRENT_RUNS_PER_MODEL = 2     # Team runs executed concurrently per model
+MAX_QUEUED_RUNS_PER_MODEL = 16        # Requests waiting for a run slot per model (above it, they are rejected)
+QUEUE_TIMEOUT_SECONDS = 60            # Requests waiting longer for a run slot are rejected
 
 class ModelName(str, Enum):
     GPT_OSS_20B = "Agentic-System-gpt-oss:20b"
     #QWEN3_30B = "Agentic-System-qwen3:30b"
     QWEN3_30B_A3B = "Agentic-System-qwen3:30b-a3b"
 
+# Context window each model is served with (passed to Ollama as 'num_ctx' - its default window is smaller)
+MODEL_CONTEXT_WINDOWS = {
+    ModelName.GPT_OSS_20B: 12288,
+    ModelName.QWEN3_30B_A3B: 12288,
+}
+RESPONSE_RESERVE_TOKENS = 4096        # Part of the window left for the response (reasoning included)
+# Prompt tokens budget per model (system message, tools schemas and history)
+MODEL_CONTEXT_TOKEN_BUDGETS = {model: window - RESPONSE_RESERVE_TOKENS for model, window in MODEL_CONTEXT_WINDOWS.items()}
+MIN_HISTORY_TOKEN_BUDGET = 1024
+
+class TeamSession:
+    """The agents of a single conversation - the team state (history) is not shared with other conversations"""
+
+    def __init__(self, conversation_id: str, assistant: AssistantAgent, team: RoundRobinGroupChat):
+        self.conversation_id = conversation_id
+        self.assistant = assistant
+        self.team = team
+        self.lock = asyncio.Lock()  # One run at a time per conversation
+        self.last_used = time.monotonic()
+
+        # The conversation as the client sees it - normalized (role, content) turns, and for each turn the number
+        # of messages in the assistant's model context once that turn is in (tool calls included)
+        self.history: list[tuple[str, str]] = []
+        self.marks: list[int] = []
+
+    async def context_messages(self) -> list:
+        """All the messages of the assistant's model context (serialized)"""
+        return (await self.assistant.model_context.save_state())["messages"]
+
+    async def add_turns(self, turns: list[tuple[str, str]]):
+        """Record the turns just processed by a run (a user turn and the assistant reply)"""
+        context_length = len(await self.context_messages())
+        for i, turn in enumerate(turns):
+            # Every turn but the last adds exactly one message, the last one ends where the context ends
+            self.marks.append(context_length if i == len(turns) - 1 else (self.marks[-1] if self.marks else 0) + 1)
+            self.history.append(turn)
+
+    async def close(self):
+        await self.assistant.close()
+
+
+class TeamPool:
+    """Bounded pool of per-conversation team sessions with LRU eviction of idle sessions"""
+
+    def __init__(self, create_session, max_sessions: int = MAX_SESSIONS_PER_MODEL,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS):
+        self.create_session = create_session
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.sessions: OrderedDict[str, TeamSession] = OrderedDict()
+
+    def find(self, conversation_id: str) -> TeamSession | None:
+        return self.sessions.get(conversation_id)
+
+    async def put(self, conversation_id: str, session: TeamSession):
+        """Add the session, replacing the current session of the conversation (if any)"""
+        replaced = self.sessions.get(conversation_id)
+        if replaced is not None and replaced is not session:
+            await self.remove(conversation_id)
+        self.sessions[conversation_id] = session
+
+    async def get(self, conversation_id: str) -> TeamSession:
+        """Return the session of the conversation, creating it if needed"""
+        await self.evict_idle()
+
+        session = self.sessions.get(conversation_id)
+        if session is None:
+            session = self.create_session(conversation_id)
+            self.sessions[conversation_id] = session
+            logger.info(f"Created team session for conversation '{conversation_id}' ({len(self.sessions)} sessions)")
+
+        self.sessions.move_to_end(conversation_id)
+        session.last_used = time.monotonic()
+        await self.evict_lru()
+        return session
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        expired = [cid for cid, session in self.sessions.items()
+                   if now - session.last_used > self.idle_ttl_seconds and not session.lock.locked()]
+        for conversation_id in expired:
+            await self.remove(conversation_id)
+
+    async def evict_lru(self):
+        # Sessions in the middle of a run are never evicted
+        for conversation_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if not self.sessions[conversation_id].lock.locked():
+                await self.remove(conversation_id)
+
+    async def remove(self, conversation_id: str, session: TeamSession | None = None):
+        """Remove the session of the conversation (only if it is still 'session', when given)"""
+        if session is not None and self.sessions.get(conversation_id) is not session:
+            return
+        session = self.sessions.pop(conversation_id, None)
+        if session is not None:
+            if not session.lock.locked():  # A running session is closed by the garbage collector once done
+                await session.close()
+            logger.info(f"Evicted team session of conversation '{conversation_id}'")
+
+    async def close(self):
+        for conversation_id in list(self.sessions):
+            await self.remove(conversation_id)
+
+
 class AgentManager:
     def __init__(self, model: ModelName, mcp_tools: list[str] = None):
         if mcp_tools is None:
             raise TypeError("mcp_tools is a required argument")
 
+        self.model = model
         self.markdown_streamer = MarkdownStreamer()
         
         self.model_client = self.create_model_client(model)
@@ -61,41 +179,42 @@ class AgentManager:
                                         #/no_think"""
         )
 
-        self.assistant = AssistantAgent(name="assistant",
-                                        model_client=self.model_client,
-                                        tools=mcp_tools,
-                                        model_client_stream=True,  # Enable streaming responses
-                                        reflect_on_tool_use=True,  # Enable reflection on tool use
-                                        system_message=system_message_template)
-        logger.info("AssistantAgent created")
+        self.system_message = system_message_template
+        self.mcp_tools = mcp_tools
+
+        # What is left of the model budget for the history, after the fixed part of the prompt
+        fixed_tokens = count_tokens(self.system_message) + sum(count_tokens(json.dumps(tool.schema)) for tool in mcp_tools)
+        self.history_token_budget = max(MIN_HISTORY_TOKEN_BUDGET, MODEL_CONTEXT_TOKEN_BUDGETS[model] - fixed_tokens)
+        logger.info(f"History token budget: {self.history_token_budget} (system message and tools: {fixed_tokens})")
 
         # User Proxy Agent
         self.user_proxy = UserProxyAgent(name="user_proxy",
                                     input_func=self.user_input_func) 
                                     #input_func=input)  # Use input() to get user input from console.
         logger.info("UserProxyAgent created")
-        
 
-        # Termination condition which will end the conversation when the user says "quit".
-        # May need also to limit number of iterations... 
-        termination = TextMentionTermination(f"{self.end_term}")
-        logger.info("TextMentionTermination condition created")
-    
-        # Create the team
-        self.team = RoundRobinGroupChat([self.assistant], #, self.user_proxy],
-                                        termination_condition=termination)
-        logger.info("RoundRobin team created")
+        # Each conversation gets its own lightweight team (agents + history), all sharing the model client and MCP tools.
+        # The number of concurrent team runs is capped per model - the caller acquires a run slot from the admission
+        # controller (and holds it for the whole run, streaming included).
+        self.team_pool = TeamPool(self.create_session)
+        self.admission = AdmissionController(model.value, max_in_flight=MAX_CONCURRENT_RUNS_PER_MODEL,
+                                             max_queue=MAX_QUEUED_RUNS_PER_MODEL,
+                                             queue_timeout_seconds=QUEUE_TIMEOUT_SECONDS)
+        logger.info("Team pool created")
 
         logger.info(f">>>>> Completed Initializing Agentic System using model: {model.value} <<<<<\n")
         
     @classmethod
-    async def async_init(cls, model: ModelName):
+    async def async_init(cls, model: ModelName, mcp_pool: McpServerPool | None = None):
         """Async Factory method that initializes the Agentic system by connecting to the MCP server,
-           creating the agents and start them"""
+           creating the agents and start them.
+           The MCP servers (and their tools) are taken from the shared pool, started here on first use."""
 
         logger.info(f">>>>> Start Initializing Agentic System using model: {model.value} <<<<<")
 
-        mcp_tools_with_autogen = await AgentManager.connect_to_servers()
+        if mcp_pool is None:
+            mcp_pool = McpServerPool()
+        mcp_tools_with_autogen = await mcp_pool.start()
 
         logger.info(f"Connected to MCP servers with tools: {[tool.name for tool in mcp_tools_with_autogen]}")
 
@@ -103,32 +222,128 @@ class AgentManager:
                
         return self
 
+    async def warm_up(self):
+        """Have the model server load the model now rather than on the first user request (Ollama loads a model
+           on its first request) - a single token is generated"""
+        start_time = time.monotonic()
+        try:
+            await self.model_client.create([UserMessage(content="Hello", source="user")],
+                                           extra_create_args={"options": {"num_predict": 1}})
+            logger.info(f"Model {self.model.value} warmed up in {time.monotonic() - start_time:.1f}s")
+        except Exception as e:
+            logger.warning(f"Model {self.model.value} warm-up failed (it will be loaded on first use): {e}")
+
+    def create_model_context(self) -> ChatCompletionContext:
+        """The model context (the history sent to the model) of a conversation, bounded by the model token budget"""
+        return TokenBudgetChatCompletionContext(self.history_token_budget)
+
+    def create_session(self, conversation_id: str) -> TeamSession:
+        """Create the agents and the team of a single conversation"""
+        assistant = AssistantAgent(name="assistant",
+                                   model_client=self.model_client,
+                                   model_context=self.create_model_context(),
+                                   tools=self.mcp_tools,
+                                   model_client_stream=True,  # Enable streaming responses
+                                   reflect_on_tool_use=True,  # Enable reflection on tool use
+                                   system_message=self.system_message)
+
+        # Termination condition which will end the conversation when the user says "quit".
+        # May need also to limit number of iterations... 
+        termination = TextMentionTermination(f"{self.end_term}")
+
+        # Create the team
+        team = RoundRobinGroupChat([assistant], #, self.user_proxy],
+                                   termination_condition=termination)
+
+        return TeamSession(conversation_id, assistant, team)
+
     async def shutdown(self):
         """Shutdown the AgentManager and its components."""
             
         await self.user_proxy.close()
-        await self.assistant.close()
+        await self.team_pool.close()
         logger.info("Agents are closed")
    
         await self.model_client.close()
         logger.info("Model client is closed")
 
-    async def process_message(self, message: str) -> TaskResult:
+    def normalize_turns(self, history: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """Normalize the (role, content) turns for comparison - the client may re-send them slightly reformatted"""
+        return [(role, " ".join(content.replace(self.end_term, "").split()))
+                for role, content in history if role in ("user", "assistant")]
+
+    async def get_session(self, conversation_id: str, history: list[tuple[str, str]] | None) -> TeamSession:
+        """Return the session of the conversation, in line with the history sent by the client.
+
+           When the client history is exactly what the session has seen, the session is reused and only the new turn
+           is sent - the prompt prefix stays identical, so the model server can reuse its KV-cache.
+           When it diverges (an edited or regenerated message), the session is forked: a new session starts from the
+           model context of the longest matching prefix (tool calls included) followed by the client's remaining turns.
+        """
+        turns = self.normalize_turns(history or [])
+        session = self.team_pool.find(conversation_id)
+        if (session is None and not turns) or (session is not None and session.history == turns):
+            return await self.team_pool.get(conversation_id)
+
+        matching = 0
+        prefix_messages = []
+        if session is not None:
+            while matching < min(len(session.history), len(turns)) and session.history[matching] == turns[matching]:
+                matching += 1
+            if matching:
+                prefix_messages = (await session.context_messages())[:session.marks[matching - 1]]
+
+        forked = self.create_session(conversation_id)
+        await forked.assistant.model_context.load_state({"messages": prefix_messages})
+        forked.history, forked.marks = list(turns[:matching]), list(session.marks[:matching]) if matching else []
+
+        remaining = [(role, content) for role, content in history if role in ("user", "assistant")][matching:]
+        for role, content in remaining:
+            message = (UserMessage(content=content, source="user") if role == "user"
+                       else AssistantMessage(content=content, source="assistant"))
+            await forked.assistant.model_context.add_message(message)
+        await forked.add_turns(turns[matching:])
+
+        if session is not None:
+            logger.info(f"Conversation '{conversation_id}' history diverged - forked at turn {matching}/{len(turns)}")
+        await self.team_pool.put(conversation_id, forked)
+        return await self.team_pool.get(conversation_id)
+
+    async def drop_unfinished_session(self, conversation_id: str, session: TeamSession):
+        """A cancelled or failed run leaves the team in the middle of a turn (its model context holds the user message
+           and tool calls its history does not) - drop it, the next request starts again from the client history"""
+        logger.info(f"Run of conversation '{conversation_id}' did not complete, dropping its team session")
+        await self.team_pool.remove(conversation_id, session)
+
+    async def process_message(self, message: str, conversation_id: str = "default",
+                              history: list[tuple[str, str]] | None = None,
+                              cancellation_token: CancellationToken | None = None) -> TaskResult:
+        """Run the team of the conversation on the message. Cancelling 'cancellation_token' stops the run
+           (the model call and the pending tool calls) and raises asyncio.CancelledError."""
 
         try:
             # Run the conversation and stream to the console.
-            logger.debug("Running the team...")
+            logger.debug(f"Running the team of conversation '{conversation_id}'...")
             #stream = self.team.run_stream()#task="Welcome the user with nice 'Hello' and ask how you can assist")
 
             #result = await self.team.run_stream(task=message)
             a = TextMessage(content=message, source="user")
             request = TextMessage.model_validate(a)
-            # await self.team.reset()  # Reset the team for a new task.
-            stream = await self.team.run(task=request)
 
-            # Remove 'self.end_term' from the response
-            if stream.messages and self.end_term in stream.messages[-1].content:
-                stream.messages[-1].content = stream.messages[-1].content.replace(self.end_term, "").strip()
+            session = await self.get_session(conversation_id, history)
+            async with session.lock:
+                try:
+                    stream = await session.team.run(task=request, cancellation_token=cancellation_token)
+                except BaseException:  # Cancelled or failed
+                    await self.drop_unfinished_session(conversation_id, session)
+                    raise
+
+                # Remove 'self.end_term' from the response
+                if stream.messages and self.end_term in stream.messages[-1].content:
+                    stream.messages[-1].content = stream.messages[-1].content.replace(self.end_term, "").strip()
+
+                reply = stream.messages[-1].content if stream.messages else ""
+                await session.add_turns(self.normalize_turns([("user", message), ("assistant", reply)]))
 
             return stream
                     
@@ -136,70 +351,83 @@ class AgentManager:
             logger.error(f"Error processing message: {e}")
             return "Error processing message"
         
-    async def process_message_stream(self, message: str):
+    async def process_message_stream(self, message: str, conversation_id: str = "default",
+                                     history: list[tuple[str, str]] | None = None,
+                                     cancellation_token: CancellationToken | None = None):
         """
-        Process messages through your AutoGen system with streaming
+        Process messages through your AutoGen system with streaming.
+        The model tokens are forwarded as they arrive (through the Markdown streamer), not after the run completes.
+        The run is cancelled when 'cancellation_token' is cancelled, or when the caller stops consuming the stream.
         """
+        tokens = self.stream_tokens(message, conversation_id, history, cancellation_token)
         try:
-            # Get the response from your AutoGen system
-            #response = await self.process_message(message)
-            #response_text = response.messages[-1].content if response.messages else "No response"
-
-            # Try 0: Simulate streaming by yielding chunks of entire response, regardless of inner structure
-            # words = response_text.split()
-            # for i, word in enumerate(words):
-            #     chunk_content = word + " " if i < len(words) - 1 else word
-            #     yield chunk_content
-            #     await asyncio.sleep(0.05)  # Small delay for streaming effect
-             
-
-            # Try 1: skipping markdown splitting
-            # paragraphs = response_text.split('\n\n')
-            
-            # for para in paragraphs:
-            #     if not para.strip():
-            #         continue
-                    
-            #     # Send complete paragraphs for better Markdown rendering
-            #     if (para.startswith('```') or para.startswith('#') or 
-            #         para.startswith('- ') or para.startswith('* ') or
-            #         para.startswith('> ')):
-            #         # Send Markdown blocks as complete units
-            #         yield para + '\n\n'
-            #         await asyncio.sleep(0.3)
-            #     else:
-            #         # Regular text - can split by sentences
-            #         sentences = para.split('. ')
-            #         for i, sentence in enumerate(sentences):
-            #             if i < len(sentences) - 1:
-            #                 yield sentence + '. '
-            #             else:
-            #                 yield sentence + '\n\n'
-            #             await asyncio.sleep(0.2)
-
-            # Try 2: Using the Markdown streamer
-            # Simulate your AutoGen system generating content
-            async def autogen_generator():
-                response = await self.process_message(message)
-                response_text = response.messages[-1].content if response.messages else "No response"
-
-                #full_response = await self.process_message(messages, model)
-                
-                # Break into chunks for streaming simulation
-                chunks = self.markdown_streamer.detect_markdown_boundaries(response_text)
-                
-                for chunk in chunks:
-                    # Simulate processing delay
-                    await asyncio.sleep(0.2)
-                    yield chunk + "\n\n"
-            
-            # Stream with markdown awareness
-            async for chunk in self.markdown_streamer.stream_with_markdown_awareness(autogen_generator()):
+            async for chunk in self.markdown_streamer.stream_with_markdown_awareness(self.strip_end_term(tokens)):
                 yield chunk
                     
         except Exception as e:
+            # Raised to the caller, which reports it as an error (and does not take the output for a response)
             logger.error(f"Error in streaming: {e}")
-            yield f"Error: {str(e)}"
+            raise
+
+        finally:
+            await tokens.aclose()  # Stops the run when the stream is closed early
+
+    async def stream_tokens(self, message: str, conversation_id: str, history: list[tuple[str, str]] | None = None,
+                            cancellation_token: CancellationToken | None = None):
+        """Run the team of the conversation and yield the model's text deltas"""
+        request = TextMessage(content=message, source="user")
+        streamed = []
+        cancellation_token = cancellation_token or CancellationToken()
+
+        session = await self.get_session(conversation_id, history)
+        async with session.lock:
+            events = session.team.run_stream(task=request, cancellation_token=cancellation_token)
+            try:
+                async for event in events:
+                    if isinstance(event, ModelClientStreamingChunkEvent):
+                        streamed.append(event.content)
+                        yield event.content
+
+                    elif isinstance(event, ToolCallRequestEvent) and streamed:
+                        # Separate the text streamed before the tool call from the reflection on its result
+                        streamed.append("\n\n")
+                        yield "\n\n"
+
+                    elif isinstance(event, TaskResult) and not streamed and event.messages:
+                        # The model client did not stream - send the final response at once
+                        streamed.append(event.messages[-1].to_text())
+                        yield streamed[-1]
+
+            except BaseException:
+                # The run failed, the token was cancelled, or the consumer went away (e.g. the client disconnected)
+                # - stop the run
+                cancellation_token.cancel()
+                await events.aclose()
+                await self.drop_unfinished_session(conversation_id, session)
+                raise
+
+            # The client will send back what it received as the assistant turn
+            await session.add_turns(self.normalize_turns([("user", message), ("assistant", "".join(streamed))]))
+
+    async def strip_end_term(self, tokens):
+        """Remove 'self.end_term' from the streamed text, even when it is split across several deltas"""
+        pending = ""
+        async for token in tokens:
+            pending = (pending + token).replace(self.end_term, "")
+
+            # Hold back only a suffix that may be the beginning of the end term
+            hold = 0
+            for size in range(min(len(pending), len(self.end_term) - 1), 0, -1):
+                if self.end_term.startswith(pending[-size:]):
+                    hold = size
+                    break
+
+            if len(pending) > hold:
+                yield pending[:len(pending) - hold]
+                pending = pending[len(pending) - hold:]
+
+        if pending:
+            yield pending
 
     async def user_input_func(self, prompt: str, cancellation_token: CancellationToken | None) -> str:
         logger.info(f"User input requested with prompt: {prompt}")
@@ -213,8 +441,11 @@ class AgentManager:
         #openai_model_client = OpenAIChatCompletionClient(model="gpt-4-turbo") #, api_key=OPENAI_API_KEY) # 
         #model_client=openai_model_client 
 
+        # The window matches the token budget of the model context - otherwise Ollama silently cuts the prompt front
+        options = {"num_ctx": MODEL_CONTEXT_WINDOWS[model]}
+
         if model == ModelName.GPT_OSS_20B:
-            local_ollama_openai_model_client = OllamaChatCompletionClient(model="gpt-oss:20b", 
+            local_ollama_openai_model_client = OllamaChatCompletionClient(model="gpt-oss:20b", options=options,
                                                                           model_info={"description": "Local Ollama GPT-OSS 20B model",
                                                                                       "vision": False,
                                                                                       "function_calling": True,
@@ -226,7 +457,7 @@ class AgentManager:
             model_client=local_ollama_openai_model_client
 
         elif model == ModelName.QWEN3_30B_A3B:
-            local_ollama_qwen_model_client = OllamaChatCompletionClient(model="qwen3:30b-a3b") # local
+            local_ollama_qwen_model_client = OllamaChatCompletionClient(model="qwen3:30b-a3b", options=options) # local
             model_client=local_ollama_qwen_model_client
 
         # local_ollama_qwen_model_client = OllamaChatCompletionClient(model="qwen3:30b", 
@@ -242,36 +473,5 @@ class AgentManager:
 
         return model_client
 
-    # Connect to all configured MCP servers
-    # Input: none
-    # Output: list of tools
-    @staticmethod
-    async def connect_to_servers() -> list[str]:
-        """Connect to all configured MCP servers."""
-        the_tools = []
-
-        try:
-            with open("server_config.json", "r") as file:
-                data = json.load(file)
-
-            # NOTE: we can integrate other public (and trusted) MCP servers
-            servers = data.get("mcpServers", {})
-            
-            for server_name, server_config in servers.items():
-                logger.debug(f"Connecting to MCP server: '{server_name}' with config: {server_config}")
-
-                # Can be done using async method
-                mcp_server_with_autogen = StdioServerParams(**server_config, read_timeout_seconds=30)
-                mcp_tools_with_autogen = await mcp_server_tools(mcp_server_with_autogen)
-                logger.debug(f"Connected to MCP server '{server_name}', Available tools: {[tool.name for tool in mcp_tools_with_autogen]}")
-
-                the_tools.extend(mcp_tools_with_autogen)
-
-        except Exception as e:
-            logger.error(f"Error loading server configuration: {e}")
-            raise
-
-        return the_tools
-
 if __name__ == "__main__":
     agent_manager = asyncio.run(AgentManager.async_init())
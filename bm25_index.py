@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import numpy as np
+from custom_logger import logger
+
+# Same defaults as rank_bm25.BM25Okapi (used by langchain's BM25Retriever)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+
+def default_tokenizer(text: str) -> list[str]:
+    # Same tokenization as langchain's BM25Retriever default preprocessing
+    return text.split()
+
+
+class BM25Index():
+    """Sparse BM25 (Okapi) index persisted as plain NumPy arrays.
+
+       The postings are stored in CSR layout - one row per vocabulary term, holding the ids of the documents
+       containing the term and the precomputed BM25 impact of the term in each of them. On startup the arrays
+       are memory-mapped, so no tokenization nor term statistics are computed again.
+    """
+
+    ARRAYS = ["indptr", "doc_ids", "impacts", "doc_len", "idf"]
+
+    def __init__(self, vocabulary: dict[str, int], arrays: dict[str, np.ndarray], meta: dict):
+        self.vocabulary = vocabulary
+        self.indptr = arrays["indptr"]
+        self.doc_ids = arrays["doc_ids"]
+        self.impacts = arrays["impacts"]
+        self.doc_len = arrays["doc_len"]
+        self.idf = arrays["idf"]
+        self.meta = meta
+        self.num_docs = meta["num_docs"]
+
+    @classmethod
+    def build(cls, texts: list[str], corpus_hash: str = "",
+              k1: float = BM25_K1, b: float = BM25_B, epsilon: float = BM25_EPSILON) -> "BM25Index":
+        """Tokenize the corpus and compute the term statistics and the postings (done once)"""
+        vocabulary = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+
+        for doc_id, text in enumerate(texts):
+            tokens = default_tokenizer(text)
+            doc_len[doc_id] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+
+        # Sort the postings by term to get the CSR layout (stable - documents stay in ascending order)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+        doc_freq = np.bincount(term_ids, minlength=len(vocabulary))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(doc_freq, out=indptr[1:])
+
+        # IDF as in BM25Okapi - negative values are replaced by epsilon * average idf
+        num_docs = len(texts)
+        idf = (np.log(num_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)).astype(np.float32)
+        if len(idf):
+            idf[idf < 0] = epsilon * idf.mean()
+
+        avgdl = float(doc_len.mean()) if num_docs else 0.0
+        norm = k1 * (1 - b + b * doc_len / avgdl) if avgdl else np.full_like(doc_len, k1)
+        impacts = (idf[term_ids] * tfs * (k1 + 1) / (tfs + norm[doc_ids])).astype(np.float32)
+
+        arrays = {"indptr": indptr, "doc_ids": doc_ids, "impacts": impacts, "doc_len": doc_len, "idf": idf}
+        meta = {"num_docs": num_docs, "avgdl": avgdl, "k1": k1, "b": b, "epsilon": epsilon, "corpus_hash": corpus_hash}
+        return cls(vocabulary, arrays, meta)
+
+    def save(self, index_dir: str):
+        """Persist the index (written to a temporary directory first, then swapped in place)"""
+        tmp_dir = f"{index_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "vocabulary.json"), "w") as file:
+            json.dump(self.vocabulary, file)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+            json.dump(self.meta, file)
+
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir: str) -> "BM25Index":
+        """Open a persisted index, memory-mapping all the arrays"""
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in cls.ARRAYS}
+        with open(os.path.join(index_dir, "vocabulary.json"), "r") as file:
+            vocabulary = json.load(file)
+        with open(os.path.join(index_dir, "meta.json"), "r") as file:
+            meta = json.load(file)
+        return cls(vocabulary, arrays, meta)
+
+    @classmethod
+    def load_or_build(cls, index_dir: str, texts: list[str], corpus_hash: str) -> "BM25Index":
+        """Open the persisted index if it was built from the same corpus, otherwise (re)build and save it"""
+        meta_path = os.path.join(index_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as file:
+                meta = json.load(file)
+            if meta.get("corpus_hash") == corpus_hash:
+                logger.info(f"Loading persisted BM25 index from '{index_dir}'")
+                return cls.load(index_dir)
+            logger.info("BM25 index is stale (corpus has changed), rebuilding it")
+
+        index = cls.build(texts, corpus_hash)
+        index.save(index_dir)
+        logger.info(f"BM25 index built for {index.num_docs} documents and saved to '{index_dir}'")
+        return cls.load(index_dir)
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query"""
+        rows = [self.vocabulary[token] for token in default_tokenizer(query) if token in self.vocabulary]
+        if not rows:
+            return np.zeros(self.num_docs, dtype=np.float32)
+
+        postings = [slice(self.indptr[row], self.indptr[row + 1]) for row in rows]
+        doc_ids = np.concatenate([self.doc_ids[p] for p in postings])
+        impacts = np.concatenate([self.impacts[p] for p in postings])
+        return np.bincount(doc_ids, weights=impacts, minlength=self.num_docs)
+
+    def search(self, query: str, k: int, mask: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return the ids and scores of the top-k documents, best first.
+           When 'mask' is given only the documents where it is True are eligible."""
+        scores = self.get_scores(query)
+        candidates = np.flatnonzero(mask) if mask is not None else np.arange(self.num_docs)
+        candidate_scores = scores[candidates]
+
+        k = min(k, len(candidates))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+
+        top = np.argpartition(-candidate_scores, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+        top = top[np.argsort(-candidate_scores[top], kind="stable")]
+        return candidates[top], candidate_scores[top]
@@ -0,0 +1,129 @@
+"""
+Offline index build for the search engine.
+
+Embeds the meals corpus across a pool of worker processes and writes the vectors to the persisted Chroma
+collection chunk by chunk, using the same ids and manifest as HybridSearch - so on its next start the
+MCP server finds the vector store up to date and embeds nothing.
+
+Usage:
+    python3 build_index.py --workers 4 --batch-size 64 --chunk-size 2048
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from langchain_chroma import Chroma
+from custom_logger import logger
+from bm25_index import BM25Index
+from cache_utils import file_sha256
+from inference_backend import INFERENCE_BACKEND, embedding_model_args, with_onnx_threads
+from search_engine import (EMBEDDING_MODEL, PERSIST_RAG_DIR, COLLECTION_NAME, BM25_INDEX_DIR, MEALS_PKL_PATH,
+                           HybridSearch, load_rag_manifest, save_rag_manifest, diff_against_manifest,
+                           remove_and_update_vstore)
+
+MANIFEST_SAVE_EVERY_CHUNKS = 10
+
+# Per worker process embedding model (set by the pool initializer)
+_worker_embeddings = None
+
+def init_worker(model_args: dict, batch_size: int, threads_per_worker: int):
+    """Load the embedding model once per worker, limiting torch (or ONNX Runtime) to its own share of the cores"""
+    global _worker_embeddings
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    torch.set_num_threads(threads_per_worker)
+    model_args = with_onnx_threads(model_args, threads_per_worker)
+    _worker_embeddings = HuggingFaceEmbeddings(**model_args, encode_kwargs={"batch_size": batch_size})
+
+def embed_chunk(texts: list[str]) -> list[list[float]]:
+    return _worker_embeddings.embed_documents(texts)
+
+def iter_chunks(items: list, chunk_size: int):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+def build_index(workers: int, batch_size: int, chunk_size: int, threads_per_worker: int):
+    start_time = time.time()
+
+    # NOTE: the corpus is a single pickled list - it is loaded once and then streamed to the workers in chunks
+    meals = HybridSearch.load_nutrition_meal_pkl()
+    texts, metadatas = zip(*meals)
+
+    # The BM25 index is cheap to build - just make sure it matches the corpus
+    BM25Index.load_or_build(BM25_INDEX_DIR, texts, file_sha256(MEALS_PKL_PATH))
+
+    os.makedirs(PERSIST_RAG_DIR, exist_ok=True)
+    vector_store = Chroma(collection_name=COLLECTION_NAME, persist_directory=PERSIST_RAG_DIR)
+    manifest = load_rag_manifest()
+    if manifest is None and vector_store._collection.count() > 0:
+        logger.info("Persisted vector store has no matching manifest (other model or inference backend), rebuilding it")
+        vector_store.reset_collection()
+    manifest = manifest or {}
+
+    documents, added, removed, changed = diff_against_manifest(manifest, texts, metadatas)
+    logger.info(f"Index build: {len(added)} to embed, {len(removed)} to remove, {len(changed)} to update "
+                f"({len(documents)} documents, {workers} workers x {threads_per_worker} threads, batch size {batch_size})")
+    remove_and_update_vstore(vector_store, documents, removed, changed)
+
+    # Manifest of what is actually stored - saved periodically so an interrupted build resumes where it stopped
+    added_set = set(added)
+    written = {doc_id: documents[doc_id] for doc_id in documents if doc_id not in added_set}
+
+    chunks = list(iter_chunks(added, chunk_size))
+    embedded = 0
+    written_chunks = 0
+    context = multiprocessing.get_context("spawn")  # torch is not fork safe
+    model_args = embedding_model_args(EMBEDDING_MODEL, INFERENCE_BACKEND)  # Exported once here, not by every worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(model_args, batch_size, threads_per_worker)) as pool:
+        pending = {}
+        next_chunk = 0
+        embed_start = time.time()
+
+        # Keep only a bounded number of chunks in flight, so vectors are never all held in memory
+        while next_chunk < len(chunks) or pending:
+            while next_chunk < len(chunks) and len(pending) < 2 * workers:
+                chunk_texts = [texts[documents[doc_id]["source_index"]] for doc_id in chunks[next_chunk]]
+                pending[pool.submit(embed_chunk, chunk_texts)] = next_chunk
+                next_chunk += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = chunks[pending.pop(future)]
+                indexes = [documents[doc_id]["source_index"] for doc_id in chunk]
+                vector_store._collection.upsert(ids=chunk,
+                                                embeddings=future.result(),
+                                                documents=[texts[i] for i in indexes],
+                                                metadatas=[{"source_index": i} for i in indexes])
+                written.update({doc_id: documents[doc_id] for doc_id in chunk})
+                embedded += len(chunk)
+                written_chunks += 1
+
+                elapsed = time.time() - embed_start
+                rate = embedded / elapsed if elapsed else 0.0
+                eta = (len(added) - embedded) / rate if rate else 0.0
+                logger.info(f"Embedded {embedded}/{len(added)} meals ({rate:.1f} docs/s, ETA {eta:.0f}s)")
+
+                if written_chunks % MANIFEST_SAVE_EVERY_CHUNKS == 0:
+                    save_rag_manifest(written)
+
+    save_rag_manifest(documents)
+    logger.info(f"Index build completed in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    cpu_count = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description="Build (or incrementally update) the search engine indexes")
+    parser.add_argument("--workers", type=int, default=max(1, cpu_count // 4), help="Number of embedding processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="Embedding model batch size")
+    parser.add_argument("--chunk-size", type=int, default=2048, help="Number of meals sent to a worker at once")
+    parser.add_argument("--threads-per-worker", type=int, default=0,
+                        help="Torch threads per worker (default: cores / workers)")
+    args = parser.parse_args()
+
+    threads_per_worker = args.threads_per_worker or max(1, cpu_count // args.workers)
+    build_index(args.workers, args.batch_size, args.chunk_size, threads_per_worker)
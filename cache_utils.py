@@ -0,0 +1,160 @@
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+from custom_logger import logger
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a free text used as a cache key - case and whitespace insensitive"""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def file_sha256(path: str) -> str:
+    """Content hash of a file (read in chunks)"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+_fingerprints = {}  # path -> ((size, mtime), sha256)
+_fingerprints_lock = threading.Lock()
+
+def files_fingerprint(paths: list[str]) -> str:
+    """Combined content hash of several files (missing files are skipped).
+       A file is re-hashed only when its size or modification time changes, so calling it per request is cheap."""
+    sha = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with _fingerprints_lock:
+            cached = _fingerprints.get(path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, file_sha256(path))
+            with _fingerprints_lock:
+                _fingerprints[path] = cached
+        sha.update(f"{path}:{cached[1]};".encode())
+    return sha.hexdigest()
+
+
+class LRUCache():
+    """Thread safe LRU cache bounded by size and (optionally) by the age of the entries.
+
+       The cache can be persisted to disk with save() and is reloaded on creation. The persisted file is tagged
+       with 'version' - a file written with another version (e.g. another model or corpus) is discarded.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float | None = None,
+                 persist_path: str | None = None, version: str = ""):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.version = version
+        self.entries = OrderedDict()  # key -> (timestamp, value)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if persist_path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _is_expired(self, timestamp: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - timestamp > self.ttl_seconds
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            timestamp, value = entry
+            if self._is_expired(timestamp, time.time()):
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def save(self):
+        """Write the (non expired) entries to 'persist_path'"""
+        if not self.persist_path:
+            return
+
+        with self.lock:
+            now = time.time()
+            entries = [(k, e) for k, e in self.entries.items() if not self._is_expired(e[0], now)]
+
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump({"version": self.version, "entries": entries}, file)
+        os.replace(tmp_path, self.persist_path)
+        logger.info(f"Saved {len(entries)} cache entries to '{self.persist_path}'")
+
+    def load(self):
+        """Reload the entries persisted by save() (if any and of the same version)"""
+        if not os.path.exists(self.persist_path):
+            return
+
+        try:
+            with open(self.persist_path, "rb") as file:
+                data = pickle.load(file)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache file '{self.persist_path}': {e}")
+            return
+
+        if data.get("version") != self.version:
+            logger.info(f"Ignoring cache file '{self.persist_path}' of another version")
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, entry in data["entries"][-self.max_size:]:
+                if not self._is_expired(entry[0], now):
+                    self.entries[key] = entry
+        logger.info(f"Loaded {len(self.entries)} cache entries from '{self.persist_path}'")
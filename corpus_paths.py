@@ -0,0 +1,10 @@
+"""
+Paths of the search engine corpus - kept apart from search_engine.py so that processes not running the search
+(e.g. the API service checking the corpus version) don't import the models.
+"""
+
+import os
+
+MEALS_PKL_PATH = "./local_db/nutrition_meals.pkl"
+PERSIST_RAG_DIR = "local_db/rag_db"
+CORPUS_FILES = [MEALS_PKL_PATH, os.path.join(PERSIST_RAG_DIR, "chroma.sqlite3")]  # The meals and the Chroma collection
@@ -0,0 +1,162 @@
+import json
+import math
+import os
+from abc import ABC, abstractmethod
+import faiss
+import numpy as np
+from custom_logger import logger
+
+CHROMA_IN_FILTER_LIMIT = 5000 # Above this number of eligible meals, the Chroma search over-fetches instead of filtering by id
+CHROMA_EXPORT_BATCH_SIZE = 5000
+
+# FAISS defaults
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+IVF_PQ_SUBQUANTIZERS = 96 # 768 / 96 = 8 dimensions per sub-quantizer (must divide the dimension)
+IVF_PQ_BITS = 8
+IVF_MIN_POINTS_PER_LIST = 39 # faiss warns when training with fewer points per centroid
+
+
+class DenseIndex(ABC):
+    """Interface of the dense (embedding) retrievers used by HybridSearch - searches return meal ids ('source_index')"""
+
+    name = "dense"
+
+    @abstractmethod
+    def search(self, embedding: list[float], k: int, mask: np.ndarray | None = None) -> list[int]:
+        """Ids of the k nearest meals, nearest first. When 'mask' is given only the meals where it is True are eligible"""
+
+
+class ChromaDenseIndex(DenseIndex):
+    """Queries the persisted Chroma collection directly (default backend)"""
+
+    name = "chroma"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def query(self, embedding: list[float], k: int, where: dict | None = None) -> list[int]:
+        # Only the meal ids are fetched (no documents, no embeddings)
+        result = self.collection.query(query_embeddings=[embedding], n_results=k, where=where, include=["metadatas"])
+        return [metadata["source_index"] for metadata in result["metadatas"][0]]
+
+    def search(self, embedding: list[float], k: int, mask: np.ndarray | None = None) -> list[int]:
+        if mask is None:
+            return self.query(embedding, k)
+
+        eligible = np.flatnonzero(mask)
+        if len(eligible) == 0:
+            return []
+        if len(eligible) <= CHROMA_IN_FILTER_LIMIT:
+            return self.query(embedding, min(k, len(eligible)), where={"source_index": {"$in": eligible.tolist()}})
+
+        # Many eligible meals - over-fetch (growing the depth) and keep the eligible ones
+        total, depth = self.collection.count(), k * 4
+        while True:
+            meal_ids = [meal_id for meal_id in self.query(embedding, min(depth, total)) if mask[meal_id]][:k]
+            if len(meal_ids) == k or depth >= total:
+                return meal_ids
+            depth *= 4
+
+
+class FaissDenseIndex(DenseIndex):
+    """Approximate nearest neighbour index (FAISS), built from the vectors already stored in Chroma - nothing is re-embedded.
+
+       kind="hnsw"  - HNSW graph over 8-bit scalar quantized vectors (4x smaller than float32), tuned by 'ef_search'.
+       kind="ivfpq" - Inverted lists with product quantization (96 bytes per 768-d vector), tuned by 'nprobe'.
+
+       The index is saved to disk, tagged with the version of the Chroma collection it was built from, and opened
+       memory-mapped (the IVF inverted lists, or the HNSW vector codes), so these pages are shared by all the
+       processes using it.
+    """
+
+    def __init__(self, kind: str, index_dir: str, collection, version: str,
+                 ef_search: int = HNSW_EF_SEARCH, nprobe: int = IVF_NPROBE, mmap: bool = True):
+        if kind not in ("hnsw", "ivfpq"):
+            raise ValueError(f"Unknown FAISS index kind '{kind}'")
+
+        self.name = f"faiss-{kind}"
+        self.kind = kind
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+
+        index_path = os.path.join(index_dir, f"{kind}.faiss")
+        meta_path = os.path.join(index_dir, f"{kind}.json")
+        if not self.is_up_to_date(meta_path, version):
+            logger.info(f"Building {self.name} index from the Chroma collection")
+            index = self.build(kind, collection)
+            self.save(index, index_dir, index_path, meta_path, version)
+
+        # IO_FLAG_MMAP only maps the IVF inverted lists - the HNSW graph and its codes need the "in-flat-codes" mapping
+        mmap_flag = faiss.IO_FLAG_MMAP_IFC if kind == "hnsw" else faiss.IO_FLAG_MMAP
+        io_flags = mmap_flag | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        self.index = faiss.read_index(index_path, io_flags)
+        logger.info(f"Loaded {self.name} index with {self.index.ntotal} vectors from '{index_path}' (mmap={mmap})")
+
+    @staticmethod
+    def is_up_to_date(meta_path: str, version: str) -> bool:
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, "r") as file:
+            return json.load(file).get("version") == version
+
+    @staticmethod
+    def export_vectors(collection) -> tuple[np.ndarray, np.ndarray]:
+        """Read all the stored vectors and their meal ids from the Chroma collection"""
+        vectors, ids = [], []
+        total = collection.count()
+        for offset in range(0, total, CHROMA_EXPORT_BATCH_SIZE):
+            batch = collection.get(include=["embeddings", "metadatas"], limit=CHROMA_EXPORT_BATCH_SIZE, offset=offset)
+            vectors.append(np.asarray(batch["embeddings"], dtype=np.float32))
+            ids.extend(metadata["source_index"] for metadata in batch["metadatas"])
+        return np.concatenate(vectors), np.asarray(ids, dtype=np.int64)
+
+    @staticmethod
+    def build(kind: str, collection) -> faiss.Index:
+        vectors, ids = FaissDenseIndex.export_vectors(collection)
+        dimension = vectors.shape[1]
+
+        # L2 distance - the same metric as the Chroma collection, so the rankings are comparable
+        if kind == "hnsw":
+            base = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+            base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        else:
+            nlist = max(1, min(int(4 * math.sqrt(len(vectors))), len(vectors) // IVF_MIN_POINTS_PER_LIST))
+            subquantizers = IVF_PQ_SUBQUANTIZERS if dimension % IVF_PQ_SUBQUANTIZERS == 0 else 1
+            # Small corpora can't train 256 codes per sub-quantizer - use fewer bits per code
+            bits = min(IVF_PQ_BITS, max(1, int(math.log2(max(2, len(vectors) // IVF_MIN_POINTS_PER_LIST)))))
+            base = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, nlist, subquantizers, bits)
+
+        base.train(vectors)
+        index = faiss.IndexIDMap2(base)
+        index.add_with_ids(vectors, ids)
+        return index
+
+    @staticmethod
+    def save(index: faiss.Index, index_dir: str, index_path: str, meta_path: str, version: str):
+        os.makedirs(index_dir, exist_ok=True)
+        faiss.write_index(index, f"{index_path}.tmp")
+        os.replace(f"{index_path}.tmp", index_path)
+        with open(meta_path, "w") as file:
+            json.dump({"version": version, "ntotal": index.ntotal}, file)
+
+    def search(self, embedding: list[float], k: int, mask: np.ndarray | None = None) -> list[int]:
+        selector = faiss.IDSelectorBatch(np.flatnonzero(mask).astype(np.int64)) if mask is not None else None
+        if self.kind == "hnsw":
+            params = faiss.SearchParametersHNSW(efSearch=max(self.ef_search, k), sel=selector)
+        else:
+            params = faiss.SearchParametersIVF(nprobe=self.nprobe, sel=selector)
+
+        _, ids = self.index.search(np.asarray([embedding], dtype=np.float32), k, params=params)
+        return [int(meal_id) for meal_id in ids[0] if meal_id >= 0]
+
+
+def create_dense_index(backend: str, collection, index_dir: str, version: str, **kwargs) -> DenseIndex:
+    """Create the dense index of the given backend: "chroma", "faiss-hnsw" or "faiss-ivfpq" """
+    if backend == "chroma":
+        return ChromaDenseIndex(collection)
+    if backend.startswith("faiss-"):
+        return FaissDenseIndex(backend.removeprefix("faiss-"), index_dir, collection, version, **kwargs)
+    raise ValueError(f"Unknown dense index backend '{backend}'")
@@ -0,0 +1,174 @@
+"""
+Inference backends of the search engine models (the BGE embedder and the MiniLM cross-encoder).
+
+- "torch"     - eager PyTorch fp32 (default)
+- "onnx"      - ONNX Runtime on CPU, fp32
+- "onnx-int8" - ONNX Runtime on CPU with dynamic int8 quantization (the instruction set is detected from the CPU)
+
+The ONNX models are exported once (with 'optimum', an optional dependency: pip install optimum[onnxruntime])
+and cached under ONNX_EXPORT_DIR.
+
+The parity check compares the rankings of an ONNX backend with the torch fp32 ones on a sample of the corpus:
+    python3 inference_backend.py --backend onnx-int8 --queries 100
+"""
+
+import argparse
+import os
+import platform
+import random
+import shutil
+import numpy as np
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from custom_logger import logger
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch") # "torch", "onnx" or "onnx-int8"
+INFERENCE_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_EXPORT_DIR = "local_db/onnx_models"
+ONNX_FILE_NAME = "onnx/model.onnx"
+
+PARITY_CORPUS_SIZE = 2000
+PARITY_TOP_K = 10
+PARITY_RERANK_CANDIDATES = 20
+
+
+def quantization_config() -> str:
+    """The dynamic quantization configuration matching the CPU (see sentence_transformers.backend)"""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            flags = file.read()
+    except OSError:
+        flags = ""
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
+
+
+def export_onnx(model_class: type, model_name: str, quantize: bool) -> tuple[str, str]:
+    """Export the model to ONNX (and quantize it) once - returns the local model directory and the ONNX file to load"""
+    export_dir = os.path.join(ONNX_EXPORT_DIR, model_name.replace("/", "__"))
+    if not os.path.exists(os.path.join(export_dir, ONNX_FILE_NAME)):
+        logger.info(f"Exporting '{model_name}' to ONNX in '{export_dir}'")
+        try:
+            model = model_class(model_name, backend="onnx")
+        except ImportError as e:
+            raise ImportError(f"The ONNX backends need 'optimum' - pip install optimum[onnxruntime] ({e})") from e
+
+        model.save_pretrained(export_dir)
+        # The ONNX file is expected in the 'onnx' sub directory (where the hub models keep it)
+        if os.path.exists(os.path.join(export_dir, "model.onnx")):
+            os.makedirs(os.path.join(export_dir, "onnx"), exist_ok=True)
+            shutil.move(os.path.join(export_dir, "model.onnx"), os.path.join(export_dir, ONNX_FILE_NAME))
+
+    if not quantize:
+        return export_dir, ONNX_FILE_NAME
+
+    config = quantization_config()
+    file_name = f"onnx/model_qint8_{config}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        logger.info(f"Quantizing '{model_name}' to int8 ({config})")
+        model = model_class(export_dir, backend="onnx", model_kwargs={"file_name": ONNX_FILE_NAME})
+        export_dynamic_quantized_onnx_model(model, config, export_dir)
+    return export_dir, file_name
+
+
+def embedding_model_args(model_name: str, backend: str = INFERENCE_BACKEND) -> dict:
+    """Arguments of HuggingFaceEmbeddings for the model on the backend"""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'")
+    if backend == "torch":
+        return {"model_name": model_name}
+
+    export_dir, file_name = export_onnx(SentenceTransformer, model_name, quantize=backend == "onnx-int8")
+    return {"model_name": export_dir, "model_kwargs": {"backend": "onnx", "model_kwargs": {"file_name": file_name}}}
+
+
+def with_onnx_threads(model_args: dict, threads: int) -> dict:
+    """Limit ONNX Runtime to 'threads' intra-op threads (it sizes its pool when the session is created).
+       Call it in the process loading the model - the session options can't be pickled."""
+    model_kwargs = model_args.get("model_kwargs", {})
+    if model_kwargs.get("backend") != "onnx":
+        return model_args
+
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = threads
+    onnx_kwargs = {**model_kwargs.get("model_kwargs", {}), "session_options": session_options}
+    return {**model_args, "model_kwargs": {**model_kwargs, "model_kwargs": onnx_kwargs}}
+
+
+def load_cross_encoder(model_name: str, backend: str = INFERENCE_BACKEND) -> CrossEncoder:
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'")
+    if backend == "torch":
+        return CrossEncoder(model_name)
+
+    export_dir, file_name = export_onnx(CrossEncoder, model_name, quantize=backend == "onnx-int8")
+    return CrossEncoder(export_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def ranking_agreement(reference: np.ndarray, candidate: np.ndarray, k: int) -> tuple[float, float]:
+    """Overlap of the top-k items and top-1 agreement of two score vectors"""
+    top_reference = np.argsort(-reference)[:k]
+    top_candidate = np.argsort(-candidate)[:k]
+    return len(set(top_reference) & set(top_candidate)) / k, float(top_reference[0] == top_candidate[0])
+
+
+def parity_check(backend: str, num_queries: int, seed: int = 0) -> dict:
+    """Compare the embedder and the cross-encoder on the backend with the torch fp32 ones, on a sample of meals.
+       Each query is the text of a meal outside of the sample - the sampled meals are ranked by embedding similarity
+       (overlap@k, top-1) and the reference top candidates are re-scored by both cross-encoders (overlap of the top 2, top-1)."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+    from search_engine import EMBEDDING_MODEL, RERANKING_MODEL, HybridSearch
+
+    texts = [text for text, _ in HybridSearch.load_nutrition_meal_pkl()]
+    shuffled = random.Random(seed).sample(texts, min(PARITY_CORPUS_SIZE + num_queries, len(texts)))
+    sample, queries = shuffled[:-num_queries], shuffled[-num_queries:]
+
+    embeddings = {}
+    for name in ("torch", backend):
+        model = HuggingFaceEmbeddings(**embedding_model_args(EMBEDDING_MODEL, name))
+        embeddings[name] = (np.asarray(model.embed_documents(queries)), np.asarray(model.embed_documents(sample)))
+
+    (reference_queries, reference_corpus), (candidate_queries, candidate_corpus) = embeddings["torch"], embeddings[backend]
+    cosine = np.sum(reference_queries * candidate_queries, axis=1) / (
+        np.linalg.norm(reference_queries, axis=1) * np.linalg.norm(candidate_queries, axis=1))
+    reference_scores, candidate_scores = reference_queries @ reference_corpus.T, candidate_queries @ candidate_corpus.T
+    embedding_agreement = np.array([ranking_agreement(reference_scores[q], candidate_scores[q], PARITY_TOP_K)
+                                    for q in range(len(queries))])
+
+    cross_encoders = {name: load_cross_encoder(RERANKING_MODEL, name) for name in ("torch", backend)}
+    rerank_agreement = []
+    for q, query in enumerate(queries):
+        candidates = [sample[i] for i in np.argsort(-reference_scores[q])[:PARITY_RERANK_CANDIDATES]]
+        pairs = [[query, text] for text in candidates]
+        scores = {name: np.asarray(model.predict(pairs, show_progress_bar=False)) for name, model in cross_encoders.items()}
+        rerank_agreement.append(ranking_agreement(scores["torch"], scores[backend], 2))
+    rerank_agreement = np.array(rerank_agreement)
+
+    report = {
+        "backend": backend,
+        "queries": len(queries),
+        "embedding_cosine_to_fp32": {"mean": float(cosine.mean()), "min": float(cosine.min())},
+        f"embedding_overlap@{PARITY_TOP_K}": float(embedding_agreement[:, 0].mean()),
+        "embedding_top1_agreement": float(embedding_agreement[:, 1].mean()),
+        "rerank_overlap@2": float(rerank_agreement[:, 0].mean()),
+        "rerank_top1_agreement": float(rerank_agreement[:, 1].mean()),
+    }
+    logger.info(f"Parity check: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the search models to ONNX and check their ranking parity with torch fp32")
+    parser.add_argument("--backend", choices=["onnx", "onnx-int8"], default="onnx-int8")
+    parser.add_argument("--queries", type=int, default=100, help="Number of sampled queries")
+    args = parser.parse_args()
+
+    for key, value in parity_check(args.backend, args.queries).items():
+        print(f"{key}: {value}")
@@ -109,41 +109,113 @@ class MarkdownStreamer:
     
     async def stream_with_markdown_awareness(self, content_generator: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
         """Stream content while preserving Markdown structure"""
-        buffer = ""
-        
+        # A chunker per stream - the streamer itself is shared by concurrent streams
+        chunker = IncrementalMarkdownChunker()
+
         async for chunk in content_generator:
-            buffer += chunk
-            
-            # Try to extract complete markdown elements
-            while buffer:
-                # Look for natural break points
-                sentences = re.split(r'([.!?]\s+)', buffer)
-                
-                if len(sentences) < 2:
-                    break
-                
-                # Build complete sentence
-                complete_part = ""
-                remaining = buffer
-                
-                for i in range(0, len(sentences) - 1, 2):
-                    if i + 1 < len(sentences):
-                        sentence = sentences[i] + sentences[i + 1]
-                        test_content = complete_part + sentence
-                        
-                        if self.is_complete_markdown_element(test_content):
-                            complete_part = test_content
-                            remaining = ''.join(sentences[i + 2:])
-                        else:
-                            break
-                
-                if complete_part and complete_part != buffer:
-                    yield complete_part
-                    buffer = remaining
-                else:
-                    # No complete elements found, wait for more content
-                    break
-        
+            complete_part = chunker.feed(chunk)
+            if complete_part:
+                yield complete_part
+
         # Send any remaining content
-        if buffer.strip():
-            yield buffer
\ No newline at end of file
+        remaining = chunker.flush()
+        if remaining.strip():
+            yield remaining
+
+
+class IncrementalMarkdownChunker:
+    """Incremental splitter of streamed Markdown into safe chunks.
+
+    Text is released at sentence boundaries ('.', '!' or '?' followed by whitespace), blank lines and code fence ends,
+    but only where no code fence, bold ('**') or inline code ('`') is left open.
+    Each character is scanned once and the state (open elements, pending boundary) is kept between chunks,
+    so the cost is amortized O(1) per character regardless of the response length.
+    """
+
+    def __init__(self):
+        self.parts = []          # Scanned text not released yet
+        self.tail = ""           # Up to 2 characters waiting for lookahead ('*' or '`' at the end of a chunk)
+        self.in_code_block = False
+        self.in_bold = False
+        self.in_inline_code = False
+        self.at_line_start = True
+        self.after_sentence_end = False
+        self.after_code_block = False
+        self.boundary_pending = False
+        self.previous = ""
+
+    def is_balanced(self) -> bool:
+        return not (self.in_code_block or self.in_bold or self.in_inline_code)
+
+    def feed(self, chunk: str, final: bool = False) -> str:
+        """Scan a new chunk and return the text that can be released (may be empty)"""
+        text = self.tail + chunk
+        cut = None
+        i = 0
+
+        while i < len(text):
+            c = text[i]
+
+            # A boundary is confirmed by the first non whitespace character following it
+            if self.boundary_pending and not c.isspace():
+                self.boundary_pending = False
+                if self.is_balanced():
+                    cut = i
+
+            if c == '`' and self.at_line_start:
+                if len(text) - i < 3 and not final and text[i:] == '`' * (len(text) - i):
+                    break  # Wait for more characters - may be a code fence
+                if text.startswith('```', i):
+                    self.in_code_block = not self.in_code_block
+                    self.after_code_block = not self.in_code_block
+                    self.at_line_start = False
+                    self.after_sentence_end = False
+                    self.previous = '`'
+                    i += 3
+                    continue
+
+            if not self.in_code_block:
+                if c == '*':
+                    if i + 1 == len(text) and not final:
+                        break  # Wait for more characters - may be a bold marker
+                    if text.startswith('**', i):
+                        self.in_bold = not self.in_bold
+                        self.at_line_start = False
+                        self.after_sentence_end = False
+                        self.previous = '*'
+                        i += 2
+                        continue
+                elif c == '`':
+                    self.in_inline_code = not self.in_inline_code
+
+            if c == '\n':
+                if self.after_sentence_end or self.after_code_block or self.previous == '\n':
+                    self.boundary_pending = True
+                self.after_code_block = False
+                self.at_line_start = True
+            else:
+                if c.isspace():
+                    if self.after_sentence_end:
+                        self.boundary_pending = True
+                else:
+                    self.after_sentence_end = c in '.!?' and not self.in_code_block
+                self.at_line_start = False
+
+            self.previous = c
+            i += 1
+
+        self.tail = text[i:]
+        if cut is None:
+            self.parts.append(text[:i])
+            return ""
+
+        released = "".join(self.parts) + text[:cut]
+        self.parts = [text[cut:i]]
+        return released
+
+    def flush(self) -> str:
+        """Return all the remaining text (end of stream)"""
+        self.feed("", final=True)
+        remaining = "".join(self.parts) + self.tail
+        self.parts, self.tail = [], ""
+        return remaining
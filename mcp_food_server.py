@@ -1,12 +1,16 @@
-import json
-import random
 import os
+import asyncio
+import atexit
 from typing import List
 from mcp.server.fastmcp import FastMCP
 from custom_logger import logger
 from search_engine import HybridSearch
+from cache_utils import LRUCache, normalize_text
 
 DB_DIRECTORY = "local_db"
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL_SECONDS = 24 * 3600
+RESULT_CACHE_PATH = None # e.g. os.path.join(DB_DIRECTORY, "result_cache.pkl") to keep the cache across restarts
 
 logger.info(f"Starting MCP Food Server. Using DB_DIRECTORY: {DB_DIRECTORY}")
 
@@ -16,6 +20,15 @@ mcp = FastMCP("food-server")
 # Initialize HybridSearch
 hybrid_search = HybridSearch()
 
+# Results cache of the search tools - the search is deterministic for a given corpus, search configuration and parameters.
+# The corpus version is part of the key (and of the persisted file), so any change of the corpus or of the
+# persisted Chroma collection invalidates the cached results. The search configuration (models, inference and dense
+# backends, rerank mode) is part of the persisted file version, so a restart with other settings starts afresh.
+result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_SECONDS, persist_path=RESULT_CACHE_PATH,
+                        version=f"{hybrid_search.search_config()}:{hybrid_search.corpus_version()}")
+if RESULT_CACHE_PATH:
+    atexit.register(result_cache.save)
+
 @mcp.tool()
 def help() -> str:
     """
@@ -27,11 +40,13 @@ def help() -> str:
     return (
         "Available tools:\n"
         "1. help() - Get a list of available tools.\n"
-        "2. get_meal_options(calorie_limit: int, protein_goal: int, num_options: int = 3) - Get meal options based on nutritional constraints.\n"
+        "2. get_meal_options(query: str, intermediate_results: int = 4, final_results: int = 2) - Get the most relevant meal options for a query.\n"
+        "3. get_meal_options_by_nutrients(query: str, min_nutrients: dict = None, max_nutrients: dict = None, ...) - Get meal options satisfying nutrition limits and goals.\n"
+        "4. get_image_for_meal(meal_name: str) - Get an image of a meal.\n"
     )
 
 @mcp.tool()
-def get_meal_options(query: str, intermediate_results: int = 4, final_results: int = 2) -> List[str]:
+async def get_meal_options(query: str, intermediate_results: int = 4, final_results: int = 2) -> List[str]:
     """
     Uses the search engine class to get most relevant meals base on the query.
     The search is performed using both BM25 and vector similarity with cross-encoding for reranking.
@@ -44,34 +59,62 @@ def get_meal_options(query: str, intermediate_results: int = 4, final_results: i
     Returns:
         A list of strings. Each string represents a meal option with all nutritional information.
     """
-    return hybrid_search.invoke(query, intermediate_results, final_results)
+    # The corpus files are re-hashed whenever they change - off the event loop
+    corpus_version = await asyncio.to_thread(hybrid_search.corpus_version)
+    key = ("get_meal_options", corpus_version, normalize_text(query), intermediate_results, final_results)
+    results = result_cache.get(key)
+    if results is not None:
+        logger.info(f"Result cache hit for query='{query}' (cache: {result_cache.stats()})")
+        return list(results)
+
+    # The search runs in the search engine threads - the server keeps serving other tool calls meanwhile
+    results = await hybrid_search.ainvoke(query, intermediate_results, final_results)
+    result_cache.put(key, list(results))
+    return results
 
-#@mcp.tool()
-def get_meal_options_naive(calorie_limit: int, protein_goal: int, num_options: int = 3) -> List[dict]:
+@mcp.tool()
+async def get_meal_options_by_nutrients(query: str,
+                                  min_nutrients: dict[str, float] | None = None,
+                                  max_nutrients: dict[str, float] | None = None,
+                                  intermediate_results: int = 4,
+                                  final_results: int = 2) -> List[str]:
     """
-    Naively filters recipes from ta json database based on nutritional constraints (as a POC).
-    
+    Gets the most relevant meals for the query among the meals satisfying numeric nutrition constraints.
+    Use it whenever the user asks for nutrition limits or goals, e.g. "under 500 calories with at least 40g protein"
+    is min_nutrients={"protein": 40}, max_nutrients={"calories": 500}.
+
+    Args:
+        query (str): The prompt text for the meal search.
+        min_nutrients (dict): Lower bounds per nutrition, e.g. {"protein": 40, "fiber": 5}.
+        max_nutrients (dict): Upper bounds per nutrition, e.g. {"calories": 500, "sodium": 300}.
+            Nutrition names: calories, total_fat, saturated_fat, cholesterol, sodium, vitamin_b12, vitamin_c,
+            vitamin_d, vitamin_e, protein, fiber, sugars (values in the units shown in the meal options).
+        intermediate_results (int): The number of intermediate results to consider by hybrid search.
+        final_results (int): The number of final results to return after cross-encoding.
+
+    Returns:
+        A list of strings. Each string represents a meal option with all nutritional information.
     """
-    json_file_path = os.path.join(DB_DIRECTORY, "recipes.json")
-    with open(json_file_path, "r") as f:
-        data = json.load(f)
-
-    if not data:
-        logger.error(f"Error reading json database file from: {json_file_path}")
-        return ["Error reading json database file."]
-
-    candidates = [
-        recipe for recipe in data 
-            if recipe['nutrition']['calories'] <= calorie_limit and recipe['nutrition']['protein'] >= protein_goal
-    ]
-
-    if len(candidates) > num_options:
-        return random.sample(candidates, num_options)
-    
-    if len(candidates) == 0:
-        return ["No suitable recipes found."]
-        
-    return candidates
+    constraints = (tuple(sorted((min_nutrients or {}).items())), tuple(sorted((max_nutrients or {}).items())))
+    corpus_version = await asyncio.to_thread(hybrid_search.corpus_version)
+    key = ("get_meal_options_by_nutrients", corpus_version, normalize_text(query),
+           constraints, intermediate_results, final_results)
+    results = result_cache.get(key)
+    if results is not None:
+        logger.info(f"Result cache hit for query='{query}', constraints={constraints} (cache: {result_cache.stats()})")
+        return list(results)
+
+    try:
+        results = await hybrid_search.ainvoke(query, intermediate_results, final_results,
+                                              min_nutrients=min_nutrients, max_nutrients=max_nutrients)
+    except ValueError as e:
+        logger.error(f"Invalid nutrition constraints: {e}")
+        return [str(e)]
+
+    if not results:
+        results = ["No meals found matching the nutrition constraints."]
+    result_cache.put(key, list(results))
+    return results
 
 @mcp.tool()
 def get_image_for_meal(meal_name: str) -> bytes:
@@ -0,0 +1,120 @@
+import asyncio
+import importlib
+import json
+import os
+from contextlib import AsyncExitStack
+from autogen_core.tools import FunctionTool
+from autogen_ext.tools.mcp import StdioServerParams, mcp_server_tools, create_mcp_server_session
+from custom_logger import logger
+
+SERVER_CONFIG_PATH = "server_config.json"
+
+
+class McpServerPool:
+    """Starts each MCP server configured in 'server_config.json' once, and shares its tools with all the agents.
+
+       Transports (per server, the "transport" key of its configuration):
+       - "stdio" (default) - one server process and one long lived client session, shared by all the tools calls
+         (without a session, every tool call would spawn a new server process).
+       - "inprocess" - the server module is imported and its tools are bound directly as function tools,
+         skipping the process and the stdio JSON round-trip. The module is named by the server "args"
+         (e.g. "mcp_food_server.py") and must expose its FastMCP instance as 'mcp'.
+
+       The sessions are opened and closed by a task of the pool itself, so start() may be awaited concurrently
+       (e.g. by several AgentManagers initializing at once) and close() from any task.
+    """
+
+    def __init__(self, config_path: str = SERVER_CONFIG_PATH):
+        self.config_path = config_path
+        self.exit_stack = AsyncExitStack()
+        self.tools = []
+        self.started = False
+        self.runner: asyncio.Task | None = None
+        self.ready: asyncio.Future | None = None
+        self.stopping: asyncio.Event | None = None
+
+    async def start(self) -> list:
+        """Connect to all configured MCP servers (once) and return all their tools."""
+        if self.runner is not None and self.runner.done() and not self.started:
+            self.runner = None  # The previous start failed - try again
+            self.exit_stack = AsyncExitStack()
+
+        if self.runner is None:
+            self.ready = asyncio.get_running_loop().create_future()
+            self.stopping = asyncio.Event()
+            self.runner = asyncio.create_task(self.run())
+
+        # Shielded - a cancelled caller does not cancel the start for the others
+        return await asyncio.shield(self.ready)
+
+    async def run(self):
+        """Owner task of the sessions - connects, then holds them open until close()"""
+        try:
+            await self.connect_all()
+        except BaseException as e:
+            logger.error(f"Error loading server configuration: {e}")
+            await self.exit_stack.aclose()
+            self.tools = []
+            if isinstance(e, asyncio.CancelledError):
+                self.ready.cancel()
+                raise
+            self.ready.set_exception(e)
+            return
+
+        self.started = True
+        self.ready.set_result(self.tools)
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.exit_stack.aclose()
+
+    async def connect_all(self):
+        with open(self.config_path, "r") as file:
+            data = json.load(file)
+
+        # NOTE: we can integrate other public (and trusted) MCP servers
+        servers = data.get("mcpServers", {})
+
+        for server_name, server_config in servers.items():
+            transport = server_config.get("transport", "stdio")
+            logger.debug(f"Connecting to MCP server: '{server_name}' ({transport}) with config: {server_config}")
+
+            if transport == "inprocess":
+                server_tools = await self.bind_in_process(server_config)
+            else:
+                server_tools = await self.connect_stdio(server_config)
+
+            logger.info(f"Connected to MCP server '{server_name}' ({transport}), Available tools: {[tool.name for tool in server_tools]}")
+            self.tools.extend(server_tools)
+
+    async def connect_stdio(self, server_config: dict) -> list:
+        params = StdioServerParams(**{key: value for key, value in server_config.items() if key != "transport"},
+                                   read_timeout_seconds=30)
+        session = await self.exit_stack.enter_async_context(create_mcp_server_session(params))
+        await session.initialize()
+        return await mcp_server_tools(params, session=session)
+
+    async def bind_in_process(self, server_config: dict) -> list:
+        module_name = os.path.splitext(os.path.basename(server_config["args"][0]))[0]
+        # Importing runs the server module body (loading the search models and indexes) - keep it off the event loop
+        module = await asyncio.to_thread(importlib.import_module, module_name)
+
+        # Sync tools are run by FunctionTool in a worker thread, async tools are awaited (and offload their own work),
+        # so the event loop is not blocked
+        return [FunctionTool(tool.fn, description=tool.description, name=tool.name)
+                for tool in module.mcp._tool_manager.list_tools()]
+
+    async def close(self):
+        """Close the sessions (and stop the server processes)."""
+        if self.runner is not None:
+            self.stopping.set()
+            if not self.ready.done():
+                self.runner.cancel()  # Still connecting
+            await asyncio.gather(self.runner, return_exceptions=True)
+            if self.ready.done() and not self.ready.cancelled():
+                self.ready.exception()  # Retrieved, so a failed start is not reported again as never retrieved
+        self.runner = None
+        self.exit_stack = AsyncExitStack()
+        self.tools = []
+        self.started = False
+        logger.info("MCP server pool is closed")
@@ -0,0 +1,81 @@
+import re
+import numpy as np
+from custom_logger import logger
+
+# Nutrition fields shown to the LLM with each meal (in the order they appear in the meal metadata)
+DISPLAY_NUTRITIONS = ['calories', 'total_fat', 'saturated_fat', 'cholesterol', 'sodium', 'vitamin_b12',
+                      'vitamin_c', 'vitamin_d', 'vitamin_e', 'protein', 'fiber', 'sugars']
+
+
+# Leading number of a value, with or without a unit (e.g. 351, "26.6g", "9.00 mg", "1,200 IU")
+LEADING_NUMBER = re.compile(r"^\s*([-+]?(?:\d[\d,]*(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)")
+
+
+def to_float(value) -> float:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = LEADING_NUMBER.match(value) if isinstance(value, str) else None
+    if match is None:
+        return np.nan
+    try:
+        return float(match.group(1).replace(",", ""))
+    except ValueError:
+        return np.nan
+
+
+class MealTable():
+    """Compact, column oriented store of the meals, indexed by 'source_index' (the position of the meal in the corpus).
+
+       Each numeric nutrition field is a NumPy column (NaN when missing), and the display string of every meal is
+       rendered once on load - so retrievers only pass meal ids around and formatting a result is a lookup.
+    """
+
+    def __init__(self, meals: list[tuple[str, dict]]):
+        self.texts = [text for text, _ in meals]
+
+        fields = {}
+        for _, metadata in meals:
+            for key in metadata:
+                if key != "source_index":
+                    fields.setdefault(key, None)
+
+        self.columns = {key: np.array([to_float(metadata.get(key)) for _, metadata in meals], dtype=np.float64)
+                        for key in fields}
+        # Drop non numeric fields (all NaN) - they are only part of the display strings
+        self.columns = {key: column for key, column in self.columns.items() if not np.isnan(column).all()}
+
+        # The nutrition tool promises these names - one with no numeric values can't be constrained (filter_mask reports
+        # it as unknown), but the meals are still searched and displayed
+        missing = [key for key in DISPLAY_NUTRITIONS if key not in self.columns]
+        if meals and missing:
+            logger.warning(f"Nutritions with no numeric values in the meals corpus (not filterable): {', '.join(missing)}")
+
+        self.display = [self.render(text, metadata) for text, metadata in meals]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @staticmethod
+    def render(text: str, metadata: dict) -> str:
+        """Meal text followed by its nutritions, e.g. 'Provolone cheese - with 351 calories, 26.6 total_fat, ...'"""
+        nutritions = ", ".join(f"{value} {key}" for key, value in metadata.items() if key in DISPLAY_NUTRITIONS)
+        return f"{text} - with {nutritions}"
+
+    def value(self, meal_id: int, key: str, default="N/A"):
+        column = self.columns.get(key)
+        if column is None or np.isnan(column[meal_id]):
+            return default
+        return column[meal_id].item()
+
+    def filter_mask(self, min_values: dict[str, float] | None = None,
+                    max_values: dict[str, float] | None = None) -> np.ndarray:
+        """Boolean mask of the meals satisfying all the range constraints (vectorized over the columns).
+           Meals missing a constrained nutrition never match."""
+        mask = np.ones(len(self), dtype=bool)
+        for constraints, compare in [(min_values or {}, np.greater_equal), (max_values or {}, np.less_equal)]:
+            for key, limit in constraints.items():
+                column = self.columns.get(key)
+                if column is None:
+                    raise ValueError(f"Unknown nutrition '{key}'. Available: {', '.join(sorted(self.columns))}")
+                mask &= compare(column, float(limit))
+        return mask
@@ -1,17 +1,113 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import json
 import uuid
 import time
+import hashlib
+import os
+from enum import Enum
 from datetime import datetime
 import asyncio
+from contextlib import asynccontextmanager
 from custom_logger import logging
 from agentic_nutrition_chatbot import AgentManager
 from agentic_nutrition_chatbot import ModelName
+from mcp_pool import McpServerPool
+from admission import AdmissionRejected, AdmissionTicket
+from autogen_core import CancellationToken
+from cache_utils import LRUCache, normalize_text, files_fingerprint
+from corpus_paths import CORPUS_FILES
 
-app = FastAPI(title="AutoGen API Bridge", version="1.0.0")
+# Initialize the wrappers - simple, 2 globals... should be in some repository
+autogen_wrappers = {}  # Global variable to hold the instance (ready models only)
+# MCP servers are started once and their tools are shared by all the models' agents
+mcp_pool = McpServerPool()
+
+DISCONNECT_POLL_SECONDS = 0.5  # How often a running request checks that its client is still connected
+
+# Responses cache - repeated prompts (greetings, common questions) are answered without running the agents.
+# Keyed by the model, the end of the conversation and the temperature, and invalidated when the search corpus changes.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL_SECONDS = 6 * 3600
+RESPONSE_CACHE_TAIL_MESSAGES = 3     # Messages at the end of the conversation the cached response depends on
+RESPONSE_REPLAY_CHUNK_SIZE = 64      # Characters per SSE chunk when replaying a cached response
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS)
+
+SERVED_MODELS = [ModelName.GPT_OSS_20B, ModelName.QWEN3_30B_A3B]
+# When set, a model is initialized (and loaded by the model server) on its first request instead of on startup
+LAZY_MODEL_INIT = os.getenv("LAZY_MODEL_INIT", "false").lower() in ("1", "true", "yes")
+
+class ModelState(str, Enum):
+    PENDING = "pending"            # Lazy init - not requested yet
+    INITIALIZING = "initializing"
+    READY = "ready"
+    FAILED = "failed"
+
+model_states = {model.value: ModelState.PENDING for model in SERVED_MODELS}
+model_errors = {}
+model_init_tasks: dict[str, asyncio.Task] = {}
+
+async def init_model(model: ModelName) -> AgentManager:
+    """Create the agent manager of the model (the MCP servers are started by the first model) and warm up the model"""
+    model_states[model.value] = ModelState.INITIALIZING
+    try:
+        agent_wrapper = await AgentManager.async_init(model=model, mcp_pool=mcp_pool)
+        await agent_wrapper.warm_up()
+    except Exception as e:
+        logging.error(f"Failed to initialize model {model.value}: {e}")
+        model_states[model.value] = ModelState.FAILED
+        model_errors[model.value] = str(e)
+        raise
+
+    autogen_wrappers[model.value] = agent_wrapper
+    model_states[model.value] = ModelState.READY
+    model_errors.pop(model.value, None)
+    return agent_wrapper
+
+def start_model_init(model: ModelName) -> asyncio.Task:
+    """Start initializing the model in the background (once, or again after a failure)"""
+    task = model_init_tasks.get(model.value)
+    if task is None or (task.done() and model_states[model.value] == ModelState.FAILED):
+        task = asyncio.create_task(init_model(model))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # The failure is logged and kept in the state
+        model_init_tasks[model.value] = task
+    return task
+
+async def get_agent_wrapper(model_name: str) -> AgentManager | None:
+    """The agent manager of the model, waiting for its initialization if needed (starting it on lazy init)"""
+    agent_wrapper = autogen_wrappers.get(model_name)
+    if agent_wrapper is not None:
+        return agent_wrapper
+    if model_name not in model_states:
+        return None
+
+    try:
+        return await asyncio.shield(start_model_init(ModelName(model_name)))
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Model {model_name} is not available: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The server starts accepting requests at once - the models are initialized concurrently in the background
+    # (requests wait for their model, /health/ready reports when all are ready)
+    if not LAZY_MODEL_INIT:
+        for model in SERVED_MODELS:
+            start_model_init(model)
+    yield
+
+    for task in model_init_tasks.values():
+        task.cancel()
+    await asyncio.gather(*model_init_tasks.values(), return_exceptions=True)
+    for agent_wrapper in autogen_wrappers.values():
+        await agent_wrapper.shutdown()
+    await mcp_pool.close()
+
+app = FastAPI(title="AutoGen API Bridge", version="1.0.0", lifespan=lifespan)
 
 # Enable CORS for Open WebUI
 app.add_middleware(
@@ -33,6 +129,9 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = None
     stream: Optional[bool] = False
+    user: Optional[str] = None
+    chat_id: Optional[str] = None
+    priority: Optional[int] = 0  # Queuing priority when the model is busy (lower first)
 
 class ChatCompletionResponse(BaseModel):
     id: str
@@ -49,16 +148,74 @@ class ChatCompletionChunk(BaseModel):
     model: str
     choices: List[Dict[str, Any]]
 
-# Initialize the wrappers - simple, 2 globals... should be in some repository
-autogen_wrappers = {}  # Global variable to hold the instance
 
-async def init_wrapper():
-    global autogen_wrappers
-    autogen_wrappers = {
-        ModelName.GPT_OSS_20B.value: await AgentManager.async_init(model=ModelName.GPT_OSS_20B),
-        ModelName.QWEN3_30B_A3B.value: await AgentManager.async_init(model=ModelName.QWEN3_30B_A3B),
+def get_conversation_id(request: ChatCompletionRequest, http_request: Request) -> str:
+    """Identify the conversation of the request, to route it to its own team session.
+       Open WebUI sends the chat id as a header (when forwarding user info headers is enabled), otherwise
+       the conversation is identified by the user and its first message."""
+    chat_id = request.chat_id or http_request.headers.get("X-OpenWebUI-Chat-Id")
+    if chat_id:
+        return chat_id
+
+    first_message = next((msg.content for msg in request.messages if msg.role == "user"), "")
+    return hashlib.sha1(f"{request.user or ''}|{first_message}".encode()).hexdigest()[:16]
+
+async def get_response_cache_key(request: ChatCompletionRequest) -> tuple | None:
+    """Key of the request in the responses cache (None when the cache is disabled)"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    tail = tuple((msg.role, normalize_text(msg.content)) for msg in request.messages[-RESPONSE_CACHE_TAIL_MESSAGES:])
+    # The corpus files are re-hashed whenever they change (the Chroma database is large) - off the event loop
+    corpus_version = await asyncio.to_thread(files_fingerprint, CORPUS_FILES)
+    return (request.model, corpus_version, tail, request.temperature)
+
+def completion_response(model: str, content: str, stop_reason: str | None) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:10]}",
+        "object": "response",
+        "status": "completed",
+        "created": int(time.time()),
+        "model": model,
+        "stop_reason": stop_reason,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {}
     }
-asyncio.run(init_wrapper())
+
+def replay_chat_completion(request: ChatCompletionRequest, content: str):
+    """Send a cached response as an SSE stream (same chunks as a streamed agents run)"""
+    from fastapi.responses import StreamingResponse
+
+    async def generate_stream():
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:10]}"
+        created = int(time.time())
+        chunk = lambda delta, finish_reason=None: {"id": completion_id, "object": "chat.completion.chunk",
+                                                   "created": created, "model": request.model,
+                                                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        yield f"data: {json.dumps(chunk({'role': 'assistant'}))}\n\n"
+        for start in range(0, len(content), RESPONSE_REPLAY_CHUNK_SIZE):
+            yield f"data: {json.dumps(chunk({'content': content[start:start + RESPONSE_REPLAY_CHUNK_SIZE]}))}\n\n"
+        yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generate_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "Connection": "keep-alive",
+                                      "Content-Type": "text/event-stream"})
+
+def get_history(request: ChatCompletionRequest) -> list[tuple[str, str]]:
+    """The conversation turns sent before the new message, matched against the team session's own history"""
+    return [(msg.role, msg.content) for msg in request.messages[:-1]]
+
+async def cancel_on_disconnect(http_request: Request, cancellation_token: CancellationToken, ticket: AdmissionTicket):
+    """Watch the client connection while the agents run - once the client is gone (e.g. Open WebUI's stop button or
+       a closed tab), cancel the run (model call and pending tool calls) and free its slot for the waiting requests"""
+    while not cancellation_token.is_cancelled():
+        if await http_request.is_disconnected():
+            logging.info("Client disconnected - cancelling the agents run")
+            cancellation_token.cancel()
+            ticket.release()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
 
 ###########################################################################
 
@@ -66,9 +223,39 @@ asyncio.run(init_wrapper())
 async def root():
     return {"message": "AutoGen API Bridge is running"}
 
+def models_status() -> dict:
+    return {name: {"state": state.value, **({"error": model_errors[name]} if name in model_errors else {})}
+            for name, state in model_states.items()}
+
+def is_ready() -> bool:
+    """Ready when all the models are (with lazy init - when none of the initialized models failed)"""
+    if LAZY_MODEL_INIT:
+        return all(state != ModelState.FAILED for state in model_states.values())
+    return all(state == ModelState.READY for state in model_states.values())
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {"status": "healthy" if is_ready() else "starting", "timestamp": datetime.now().isoformat(),
+            "models": models_status()}
+
+@app.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+@app.get("/health/ready")
+async def readiness():
+    """The models can take traffic - 503 while they are initializing (or when one failed)"""
+    content = {"status": "ready" if is_ready() else "not_ready", "timestamp": datetime.now().isoformat(),
+               "lazy_init": LAZY_MODEL_INIT, "models": models_status()}
+    return JSONResponse(status_code=200 if is_ready() else 503, content=content)
+
+@app.get("/metrics")
+async def metrics():
+    """Admission control metrics (in flight, queue depth and wait times) per model"""
+    return {"timestamp": datetime.now().isoformat(),
+            "models": {name: agent_wrapper.admission.stats() for name, agent_wrapper in autogen_wrappers.items()},
+            "response_cache": response_cache.stats() if RESPONSE_CACHE_ENABLED else None}
 
 @app.get("/v1/models")
 async def list_models():
@@ -98,26 +285,47 @@ async def list_models():
     }
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
     """OpenAI-compatible chat completions endpoint"""
 
-    # TODO - Reset the team when new Chat starts (according to the length of the history)
-
     # Add logging for debugging
     logging.info(f"Received request: stream={request.stream}, model={request.model}")
     logging.info(f"Messages: {[msg for msg in request.messages]}")
     
     # Set active model
-    agent_wrapper = autogen_wrappers.get(request.model)
+    agent_wrapper = await get_agent_wrapper(request.model)
     if not agent_wrapper:
         raise HTTPException(status_code=400, detail=f"Model {request.model} not supported")
 
+    # Repeated prompt - answer from the cache, without running the agents (the team session catches up with the
+    # cached turn from the history of the next request)
+    cache_key = await get_response_cache_key(request)
+    cached_content = response_cache.get(cache_key) if cache_key else None
+    if cached_content is not None:
+        logging.info("Answering from the responses cache")
+        if request.stream:
+            return replay_chat_completion(request, cached_content)
+        return completion_response(request.model, cached_content, "cached")
+
+    # Each conversation runs on its own team session
+    conversation_id = get_conversation_id(request, http_request)
+
+    # Wait for a run slot of the model (or reject the request when the model is overloaded)
+    try:
+        ticket = await agent_wrapper.admission.acquire(request.priority or 0)
+    except AdmissionRejected as e:
+        logging.warning(f"Request rejected: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
     if request.stream:
-        return await stream_chat_completions(agent_wrapper, request)
+        return await stream_chat_completions(agent_wrapper, request, http_request, conversation_id, ticket, cache_key)
 
+    cancellation_token = CancellationToken()
+    watcher = asyncio.create_task(cancel_on_disconnect(http_request, cancellation_token, ticket))
     try:
         # Process through AutoGen
-        response_content = await agent_wrapper.process_message(request.messages[-1].content)
+        response_content = await agent_wrapper.process_message(request.messages[-1].content, conversation_id,
+                                                                get_history(request), cancellation_token)
 
         logging.info(f"Generated response: {response_content}")
         
@@ -144,6 +352,9 @@ async def chat_completions(request: ChatCompletionRequest):
             }
         }
         
+        if cache_key and response_content.messages[-1].content.strip():
+            response_cache.put(cache_key, response_content.messages[-1].content)
+
         logging.info(f"Sending response: {response}")
         return response
         
@@ -158,9 +369,23 @@ async def chat_completions(request: ChatCompletionRequest):
         }
         return error_response
 
-async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatCompletionRequest):
-    """Handle streaming chat completions"""
+    except asyncio.CancelledError:
+        if not cancellation_token.is_cancelled():
+            raise
+        # Nobody is waiting for this response anymore
+        return {"error": {"message": "Client disconnected", "type": "cancelled", "code": "client_disconnected"}}
+
+    finally:
+        watcher.cancel()
+        ticket.release()
+
+async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatCompletionRequest, http_request: Request,
+                                  conversation_id: str, ticket: AdmissionTicket, cache_key: tuple | None = None):
+    """Handle streaming chat completions - the run slot ('ticket') is held until the stream ends,
+       and the run is cancelled if the client disconnects in the middle.
+       A completed response is added to the responses cache (under 'cache_key')."""
     from fastapi.responses import StreamingResponse
+    from starlette.background import BackgroundTask
     import json
     
     async def generate_stream():
@@ -168,6 +393,11 @@ async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatComp
         created = int(time.time())
         
         logging.info("Starting streaming response")
+
+        cancellation_token = CancellationToken()
+        watcher = asyncio.create_task(cancel_on_disconnect(http_request, cancellation_token, ticket))
+        completed = False
+        streamed = []
         
         try:
             # Send initial chunk
@@ -186,7 +416,8 @@ async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatComp
             }
             yield f"data: {json.dumps(initial_chunk)}\n\n"
 
-            async for chunk_content in agent_wrapper.process_message_stream(request.messages[-1].content):
+            async for chunk_content in agent_wrapper.process_message_stream(request.messages[-1].content, conversation_id,
+                                                                              get_history(request), cancellation_token):
 
                 chunk = {
                     "id": completion_id,
@@ -203,6 +434,7 @@ async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatComp
                 }
                 
                 yield f"data: {json.dumps(chunk)}\n\n"
+                streamed.append(chunk_content)
             
             # Send final chunk
             final_chunk = {
@@ -219,8 +451,16 @@ async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatComp
             
             yield f"data: {json.dumps(final_chunk)}\n\n"
             yield "data: [DONE]\n\n"
+            completed = True
+            if cache_key and "".join(streamed).strip():
+                response_cache.put(cache_key, "".join(streamed))
             
             logging.info("Streaming response completed")
+
+        except asyncio.CancelledError:
+            if not cancellation_token.is_cancelled():
+                raise
+            logging.info("Streaming response cancelled (client disconnected)")
             
         except Exception as e:
             logging.error(f"Streaming error: {e}")
@@ -241,10 +481,17 @@ async def stream_chat_completions(agent_wrapper: AgentManager, request: ChatComp
             }
             yield f"data: {json.dumps(error_chunk)}\n\n"
             yield "data: [DONE]\n\n"
+
+        finally:
+            watcher.cancel()
+            if not completed:
+                cancellation_token.cancel()  # The stream was closed early (client gone) - stop the agents run
+            ticket.release()
     
     return StreamingResponse(
         generate_stream(), 
         media_type="text/event-stream",
+        background=BackgroundTask(ticket.release),  # In case the stream never started
         headers={
             "Cache-Control": "no-cache", 
             "Connection": "keep-alive",
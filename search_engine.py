@@ -1,19 +1,52 @@
 import pickle
 import os
+import asyncio
+import json
+import hashlib
 import time
-from sentence_transformers import CrossEncoder
+import threading
+import queue
+import atexit
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
+from bm25_index import BM25Index
+from meal_table import MealTable
+from dense_index import DenseIndex, create_dense_index
+from cache_utils import LRUCache, normalize_text, file_sha256, files_fingerprint
+from corpus_paths import MEALS_PKL_PATH, PERSIST_RAG_DIR, CORPUS_FILES
+from inference_backend import INFERENCE_BACKEND, embedding_model_args, load_cross_encoder
 from custom_logger import logger
 
     
 #EMBEDDING_MODEL = "all-MiniLM-L6-v2" #MiniLM (384)
 EMBEDDING_MODEL = "BAAI/bge-base-en-v1.5" #BGE-Base (768)
 RERANKING_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2" #"cross-encoder/ms-marco-TinyBERT-v2" # Cross-Encoder model
-PERSIST_RAG_DIR  = "local_db/rag_db"
+BM25_INDEX_DIR = "local_db/bm25_index"
+RAG_MANIFEST_PATH = os.path.join(PERSIST_RAG_DIR, "manifest.json")
+CHROMA_WRITE_BATCH_SIZE = 512
+DENSE_BACKEND = "chroma" # "chroma", "faiss-hnsw" (8-bit quantized HNSW) or "faiss-ivfpq" (IVF with product quantization)
+DENSE_INDEX_DIR = "local_db/dense_index"
 COLLECTION_NAME = "meal_nutrition_collection"
+RERANK_BATCH_SIZE = 64
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_CACHE_TTL_SECONDS = 7 * 24 * 3600
+EMBEDDING_CACHE_PATH = None # e.g. "local_db/query_embedding_cache.pkl" to keep the cache across restarts
+PAIR_SCORE_CACHE_SIZE = 65536 # Cross-encoder scores of (query, meal) pairs
+PAIR_SCORE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+PAIR_SCORE_CACHE_PATH = None # e.g. "local_db/pair_score_cache.pkl" to keep the cache across restarts
+FUSION_WEIGHTS = (0.5, 0.5) # BM25, vector store
+RRF_C = 60 # Reciprocal Rank Fusion constant (same default as langchain's EnsembleRetriever)
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4")) # Threads running the searches of 'ainvoke' (torch, numpy and chroma release the GIL)
+# Micro-batching of concurrent queries - a batch is sent to the model once complete or after waiting at most BATCH_MAX_WAIT_SECONDS
+BATCH_MAX_WAIT_SECONDS = 0.005
+# All the submits come from the 'ainvoke' thread pool, so at most SEARCH_WORKERS queries are ever pending -
+# the pool size bounds the batches (raise SEARCH_WORKERS for larger ones)
+EMBED_MAX_BATCH = SEARCH_WORKERS # Queries embedded together
+RERANK_MAX_BATCH = SEARCH_WORKERS # Queries whose candidates are reranked together
+RERANK_MODE = os.getenv("RERANK_MODE", "full") # "full" or "adaptive" (skip or shorten the reranking when possible)
 
 
 # def load_nutritions_text_file() -> list[str]:
@@ -22,94 +55,363 @@ COLLECTION_NAME = "meal_nutrition_collection"
 #             documents = [line for line in file.readlines()]
 #         return documents
 
+def meal_document_ids(texts: list[str]) -> list[str]:
+    """Stable Chroma ids derived from the meal text (plus an occurrence counter for duplicated texts),
+       so a meal keeps its id when other meals are added or removed from the corpus"""
+    ids, seen = [], {}
+    for text in texts:
+        digest = hashlib.sha1(text.encode()).hexdigest()[:20]
+        seen[digest] = seen.get(digest, -1) + 1
+        ids.append(f"meal-{digest}-{seen[digest]}")
+    return ids
+
+def meal_content_hash(text: str, metadata: dict) -> str:
+    """Hash of the whole meal document (text and nutrition metadata, excluding its position in the corpus)"""
+    nutrition = {key: value for key, value in metadata.items() if key != "source_index"}
+    content = text + json.dumps(nutrition, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def load_rag_manifest() -> dict | None:
+    """Load the manifest of the persisted vector store: {doc id: {"hash": content hash, "source_index": i}}.
+       None when the vectors were embedded by another model or inference backend (they can't be mixed)."""
+    if not os.path.exists(RAG_MANIFEST_PATH):
+        return None
+
+    with open(RAG_MANIFEST_PATH, 'r') as file:
+        manifest = json.load(file)
+    if manifest.get("embedding_model") != EMBEDDING_MODEL or manifest.get("inference_backend") != INFERENCE_BACKEND:
+        return None
+    return manifest["documents"]
+
+def save_rag_manifest(documents: dict):
+    tmp_path = f"{RAG_MANIFEST_PATH}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({"embedding_model": EMBEDDING_MODEL, "inference_backend": INFERENCE_BACKEND, "documents": documents}, file)
+    os.replace(tmp_path, RAG_MANIFEST_PATH)
+
+def diff_against_manifest(manifest: dict, texts: list[str], metadatas: list[dict]) -> tuple[dict, list, list, list]:
+    """Compare the corpus with the manifest of the vector store.
+       Returns the new manifest documents and the ids to add, to remove and to update (metadata only)"""
+    ids = meal_document_ids(texts)
+    documents = {doc_id: {"hash": meal_content_hash(text, metadata), "source_index": i}
+                 for i, (doc_id, text, metadata) in enumerate(zip(ids, texts, metadatas))}
+
+    added = [doc_id for doc_id in ids if doc_id not in manifest]
+    removed = [doc_id for doc_id in manifest if doc_id not in documents]
+    changed = [doc_id for doc_id in ids if doc_id in manifest and manifest[doc_id] != documents[doc_id]]
+    return documents, added, removed, changed
+
+def remove_and_update_vstore(vector_store: Chroma, documents: dict, removed: list[str], changed: list[str]):
+    # Chroma only keeps the meal id ('source_index') as metadata - the nutritions are served by the MealTable
+    for start in range(0, len(removed), CHROMA_WRITE_BATCH_SIZE):
+        vector_store.delete(ids=removed[start:start + CHROMA_WRITE_BATCH_SIZE])
+
+    for start in range(0, len(changed), CHROMA_WRITE_BATCH_SIZE):
+        batch = changed[start:start + CHROMA_WRITE_BATCH_SIZE]
+        vector_store._collection.update(ids=batch,
+                                        metadatas=[{"source_index": documents[doc_id]["source_index"]} for doc_id in batch])
+
+def reciprocal_rank_fusion_scores(id_lists: list[list[int]], weights: list[float], c: int = RRF_C) -> dict[int, float]:
+    """Weighted Reciprocal Rank Fusion scores of the meals, best first.
+       Same semantics as langchain's EnsembleRetriever: each list adds weight / (rank + c) to a meal,
+       ties keep the order of first occurrence."""
+    rrf_scores = {}
+    for id_list, weight in zip(id_lists, weights):
+        for rank, meal_id in enumerate(id_list, start=1):
+            rrf_scores[meal_id] = rrf_scores.get(meal_id, 0.0) + weight / (rank + c)
+
+    return {meal_id: rrf_scores[meal_id] for meal_id in sorted(rrf_scores, key=lambda meal_id: rrf_scores[meal_id], reverse=True)}
+
+def reciprocal_rank_fusion(id_lists: list[list[int]], weights: list[float], c: int = RRF_C) -> list[int]:
+    """Fuse ranked lists of meal ids with weighted Reciprocal Rank Fusion (see reciprocal_rank_fusion_scores)"""
+    return list(reciprocal_rank_fusion_scores(id_lists, weights, c))
+
+
+class Reranker():
+    """Long-lived cross-encoder, loaded once and shared by all the queries of the process.
+       Pairs of several queries can be scored together in one batched forward pass."""
+
+    def __init__(self, model_name: str = RERANKING_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 backend: str = INFERENCE_BACKEND):
+        self.batch_size = batch_size
+        self.model = load_cross_encoder(model_name, backend)
+        # The model is not guaranteed to be thread safe - serialize the forward passes
+        self.lock = threading.Lock()
+        logger.info(f"Reranker model '{model_name}' loaded (backend: {backend}, batch size: {batch_size})")
+
+    def score(self, query: str, texts: list[str]) -> list[float]:
+        """Score all the (query, text) pairs of a single query"""
+        return self.score_many([(query, texts)])[0]
+
+    def score_many(self, requests: list[tuple[str, list[str]]]) -> list[list[float]]:
+        """Score the candidates of several queries at once.
+           All pairs are flattened into shared batches and the scores are split back per query."""
+        pairs = [[query, text] for query, texts in requests for text in texts]
+        if not pairs:
+            return [[] for _ in requests]
+
+        with self.lock:
+            scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+
+        results, start = [], 0
+        for _, texts in requests:
+            results.append([float(s) for s in scores[start:start + len(texts)]])
+            start += len(texts)
+        return results
+
+
+class MicroBatcher():
+    """Collects the items submitted concurrently (from any thread) and processes them together in one call.
+
+       A dedicated thread takes the first waiting item, then keeps collecting for at most 'max_wait_seconds'
+       up to 'max_batch' items, calls 'process' once on the batch and hands each caller its own result.
+       It waits only for callers already submitting - a lone caller is processed at once, without added latency.
+    """
+
+    def __init__(self, name: str, process: Callable[[list], list], max_batch: int,
+                 max_wait_seconds: float = BATCH_MAX_WAIT_SECONDS):
+        self.name = name
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait_seconds = max_wait_seconds
+        self.queue = queue.Queue()
+        self.pending = 0  # Submitted items not taken into a batch yet
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self.run, name=f"{name}-batcher", daemon=True).start()
+
+    def submit(self, item) -> Any:
+        """Process the item (within a batch) and return its result - blocks the calling thread until then"""
+        future = Future()
+        with self.lock:
+            self.pending += 1
+        self.queue.put((item, future))
+        return future.result()
+
+    def collect(self) -> list[tuple[Any, Future]]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch:
+            with self.lock:
+                waiting = self.pending - len(batch)
+            timeout = deadline - time.monotonic()
+            if waiting <= 0 or timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        with self.lock:
+            self.pending -= len(batch)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                results = self.process([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items,
+                "average_batch_size": self.items / self.batches if self.batches else 0.0}
+
+
 class HybridSearch():
     #solo_search_depth: int = 20
     #rerank_search_depth: int = 10
 
-    def __init__(self):        
+    def __init__(self, fusion_weights: tuple[float, float] = FUSION_WEIGHTS, dense_backend: str = DENSE_BACKEND,
+                 search_workers: int = SEARCH_WORKERS, **dense_index_kwargs):
+        """search_workers - size of the thread pool of 'ainvoke' (bounds the searches running at once)
+           dense_index_kwargs - tuning of the ANN backends, e.g. ef_search=128 (faiss-hnsw), nprobe=32 (faiss-ivfpq), mmap=False"""
+        self.fusion_weights = fusion_weights
+        self.dense_index_kwargs = dense_index_kwargs
+        self.executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="hybrid-search")
         meals = self.load_nutrition_meal_pkl()    
         texts, metadatas = zip(*meals)
+        # The meals metadata is kept only in the columnar table - the retrievers work with meal ids ('source_index')
+        self.meals = MealTable(meals)
+
+        # Query embeddings are cached - BGE is uncased so the normalized (lower-cased) query is a safe key
+        self.embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL_SECONDS,
+                                        persist_path=EMBEDDING_CACHE_PATH, version=f"{EMBEDDING_MODEL}:{INFERENCE_BACKEND}")
+        if EMBEDDING_CACHE_PATH:
+            atexit.register(self.embedding_cache.save)
+
+        # Cross-encoder scores are cached per (query, meal) pair - the model is uncased, so the normalized query is a
+        # safe key. Meal ids are positions in the corpus, so a persisted cache is only valid for the same corpus.
+        self.pair_score_cache = LRUCache(PAIR_SCORE_CACHE_SIZE, PAIR_SCORE_CACHE_TTL_SECONDS,
+                                         persist_path=PAIR_SCORE_CACHE_PATH,
+                                         version=f"{RERANKING_MODEL}:{INFERENCE_BACKEND}:{file_sha256(MEALS_PKL_PATH)}")
+        if PAIR_SCORE_CACHE_PATH:
+            atexit.register(self.pair_score_cache.save)
 
         self.vector_store = self.build_or_load_vstore(texts, metadatas)
+        self.dense_index = self.set_dense_index(dense_backend, **dense_index_kwargs)
         self.bm25 = self.set_bm25(texts, metadatas)
-        logger.info("Done initializing HybridSearch")
+        self.reranker = Reranker()
+
+        # Concurrent searches share the model forward passes - queries are embedded and reranked in batches
+        self.embedding_batcher = MicroBatcher("embedding", self.embedding_model.embed_documents,
+                                              min(EMBED_MAX_BATCH, search_workers))
+        self.rerank_batcher = MicroBatcher("rerank", self.reranker.score_many, min(RERANK_MAX_BATCH, search_workers))
+        logger.info(f"Done initializing HybridSearch ({len(self.meals)} meals)")
 
-    def load_nutrition_meal_pkl(self) -> list[tuple[str, dict]]:
+    @staticmethod
+    def load_nutrition_meal_pkl() -> list[tuple[str, dict]]:
         # Load all the documents from the file 'nutrition_meal.pkl' into a list of tuples
-        with open('./local_db/nutrition_meals.pkl', 'rb') as file:
+        with open(MEALS_PKL_PATH, 'rb') as file:
             return pickle.load(file)
 
-    def set_bm25(self, texts: list[str], metadatas: list[dict]) -> BM25Retriever:
-        bm25 = BM25Retriever.from_texts(texts, metadatas)
-        
-        return bm25
+    def set_bm25(self, texts: list[str], metadatas: list[dict]) -> BM25Index:
+        # Open the persisted (memory-mapped) index, it is rebuilt only when the pickle content changes
+        return BM25Index.load_or_build(BM25_INDEX_DIR, texts, file_sha256(MEALS_PKL_PATH))
+
+    def bm25_search(self, query: str, k: int, mask: np.ndarray | None = None) -> list[int]:
+        meal_ids, _ = self.bm25.search(query, k, mask)
+        return meal_ids.tolist()
+
+    def vector_search(self, query: str, k: int, mask: np.ndarray | None = None) -> list[int]:
+        return self.dense_index.search(self.embed_query(query), k, mask)
+
+    def set_dense_index(self, backend: str, **kwargs) -> DenseIndex:
+        # ANN backends are built from the vectors stored in Chroma and rebuilt whenever the collection changes
+        version = file_sha256(RAG_MANIFEST_PATH) if os.path.exists(RAG_MANIFEST_PATH) else ""
+        dense_index = create_dense_index(backend, self.vector_store._collection, DENSE_INDEX_DIR, version, **kwargs)
+        logger.info(f"Dense retrieval backend: {dense_index.name}")
+        return dense_index
 
     def build_or_load_vstore(self, texts: list[str], metadatas: list[dict]) -> Chroma:
         os.makedirs(PERSIST_RAG_DIR, exist_ok=True)
-        embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-
-        # Reuse existing persisted collection if present
-        if any(os.scandir(PERSIST_RAG_DIR)):
-            return Chroma(collection_name=COLLECTION_NAME,
-                          embedding_function=embedding_model,
-                          persist_directory=PERSIST_RAG_DIR)
-        
-        #metadatas = [{"source_index": i} for i in range(len(documents))]
-        # Add to the metadatas also the index of each document
-        for i in range(len(metadatas)):
-            metadatas[i]['source_index'] = i
-        
-        return Chroma.from_texts(
-                texts=list(texts),
-                embedding=embedding_model,
-                metadatas=metadatas,
-                collection_name=COLLECTION_NAME,
-                persist_directory=PERSIST_RAG_DIR
-        )
-
-    def invoke(self, query: str, intermediate_results: int, final_results: int, print_results: bool = False) -> list[str]:
-        logger.info(f"Starting 'invoke' with parameters: query='{query}', intermediate_results={intermediate_results}, final_results={final_results}")
-
-        # Perform the initial retrieval from bm25 and vector store
-        self.bm25.k = intermediate_results
-        bm25_results = self.bm25.invoke(query)        
-        vector_store_results = self.vector_store.similarity_search(query, k=intermediate_results)
-
-        ensemble = EnsembleRetriever(
-            retrievers=[self.bm25, self.vector_store.as_retriever(search_kwargs={"k": intermediate_results})],
-            weights=[0.5, 0.5]
-        )
-        hybrid_results = ensemble.invoke(query)
-
-        # Rerank the hybrid results
-        reranker = CrossEncoder(RERANKING_MODEL)
-        pairs = [[query, c.page_content] for c in hybrid_results]
-        scores = reranker.predict(pairs)
-
-        reranked = [
-            c for _, c in sorted(zip(scores, hybrid_results), key=lambda x: x[0], reverse=True)
-        ][:final_results]
+        embedding_model = HuggingFaceEmbeddings(**embedding_model_args(EMBEDDING_MODEL, INFERENCE_BACKEND))
+        self.embedding_model = embedding_model
+
+        vector_store = Chroma(collection_name=COLLECTION_NAME,
+                              embedding_function=embedding_model,
+                              persist_directory=PERSIST_RAG_DIR)
+
+        manifest = load_rag_manifest()
+        if manifest is None and vector_store._collection.count() > 0:
+            # Collection persisted before the manifest existed (random ids), or embedded by another model or
+            # inference backend - it can't be diffed, start over
+            logger.info("Persisted vector store has no matching manifest, rebuilding it")
+            vector_store.reset_collection()
+        manifest = manifest or {}
+
+        self.sync_vstore(vector_store, manifest, texts, metadatas)
+        return vector_store
+
+    def sync_vstore(self, vector_store: Chroma, manifest: dict, texts: list[str], metadatas: list[dict]):
+        """Incrementally bring the vector store in line with the corpus:
+           only new meals are embedded, removed meals are deleted and meals whose metadata (or position)
+           changed are updated in place (the text is unchanged, so no re-embedding is needed)."""
+        documents, added, removed, changed = diff_against_manifest(manifest, texts, metadatas)
+        if not (added or removed or changed):
+            logger.info(f"Vector store is up to date ({len(documents)} documents)")
+            return
+
+        logger.info(f"Syncing vector store: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+        remove_and_update_vstore(vector_store, documents, removed, changed)
+
+        for start in range(0, len(added), CHROMA_WRITE_BATCH_SIZE):
+            batch = added[start:start + CHROMA_WRITE_BATCH_SIZE]
+            indexes = [documents[doc_id]["source_index"] for doc_id in batch]
+            vector_store.add_texts(texts=[texts[i] for i in indexes],
+                                   metadatas=[{"source_index": i} for i in indexes],
+                                   ids=batch)
+
+        save_rag_manifest(documents)
+        logger.info("Vector store synced with the corpus")
+
+    def corpus_version(self) -> str:
+        """Content hash of the meals corpus and of the persisted Chroma collection.
+           Changes whenever either of them changes (cheap to call - files are re-hashed only when modified)."""
+        return files_fingerprint(CORPUS_FILES)
+
+    def search_config(self) -> str:
+        """The settings changing the search results for a given corpus (models, backends and tuning)"""
+        tuning = ",".join(f"{key}={value}" for key, value in sorted(self.dense_index_kwargs.items()) if key != "mmap")
+        return (f"{EMBEDDING_MODEL}:{RERANKING_MODEL}:{INFERENCE_BACKEND}:{self.dense_index.name}({tuning}):"
+                f"{RERANK_MODE}:rrf{self.fusion_weights},{RRF_C}")
+
+    def embed_query(self, query: str) -> list[float]:
+        """Embed the query, reusing the cached vector of an identical (normalized) query"""
+        key = normalize_text(query)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embedding_batcher.submit(key)
+            self.embedding_cache.put(key, embedding)
+        return embedding
+
+    def embedding_cache_stats(self) -> dict:
+        return self.embedding_cache.stats()
+
+    def batching_stats(self) -> dict:
+        return {"embedding": self.embedding_batcher.stats(), "rerank": self.rerank_batcher.stats()}
+
+    def invoke(self, query: str, intermediate_results: int, final_results: int, print_results: bool = False,
+               min_nutrients: dict[str, float] | None = None, max_nutrients: dict[str, float] | None = None) -> list[str]:
+        logger.info(f"Starting 'invoke' with parameters: query='{query}', intermediate_results={intermediate_results}, final_results={final_results}, "
+                    f"min_nutrients={min_nutrients}, max_nutrients={max_nutrients}")
+
+        # Nutrition constraints are applied by the retrievers, so only eligible meals reach the cross-encoder
+        mask = self.meals.filter_mask(min_nutrients, max_nutrients) if (min_nutrients or max_nutrients) else None
+
+        # Perform the initial retrieval from bm25 and vector store - each retriever runs exactly once
+        bm25_results = self.bm25_search(query, intermediate_results, mask)
+        vector_store_results = self.vector_search(query, intermediate_results, mask)
+
+        return self.fuse_and_rerank(query, bm25_results, vector_store_results, final_results, print_results)
+
+    async def ainvoke(self, query: str, intermediate_results: int, final_results: int,
+                      min_nutrients: dict[str, float] | None = None,
+                      max_nutrients: dict[str, float] | None = None) -> list[str]:
+        """Same as 'invoke', without blocking the event loop - BM25 and the dense retrieval run concurrently in the
+           search thread pool, then the fusion and the reranking run there as well"""
+        logger.info(f"Starting 'ainvoke' with parameters: query='{query}', intermediate_results={intermediate_results}, final_results={final_results}, "
+                    f"min_nutrients={min_nutrients}, max_nutrients={max_nutrients}")
+        loop = asyncio.get_running_loop()
+
+        mask = self.meals.filter_mask(min_nutrients, max_nutrients) if (min_nutrients or max_nutrients) else None
+
+        bm25_results, vector_store_results = await asyncio.gather(
+            loop.run_in_executor(self.executor, self.bm25_search, query, intermediate_results, mask),
+            loop.run_in_executor(self.executor, self.vector_search, query, intermediate_results, mask))
+
+        return await loop.run_in_executor(self.executor, self.fuse_and_rerank,
+                                          query, bm25_results, vector_store_results, final_results)
+
+    def fuse_and_rerank(self, query: str, bm25_results: list[int], vector_store_results: list[int],
+                        final_results: int, print_results: bool = False) -> list[str]:
+        # Fuse the two lists in-process (instead of querying both retrievers again via EnsembleRetriever)
+        fused_scores = reciprocal_rank_fusion_scores([bm25_results, vector_store_results], self.fusion_weights)
+        hybrid_results = list(fused_scores)
+
+        if RERANK_MODE == "adaptive":
+            reranked = self.adaptive_rerank(query, bm25_results, vector_store_results, fused_scores, final_results)
+        else:
+            reranked = self.rerank(query, hybrid_results)[:final_results]
 
         if print_results:
             self.print_results(bm25_results, vector_store_results, hybrid_results, reranked)
 
-        #return [f"{doc.page_content} - Nutritions: {doc.metadata}" for doc in reranked]
-
-        # convert doc.metadata to a simple string such as "calories: 100, protein: 10g"
-        #for doc in reranked:
-        #    doc.metadata = ", ".join(f"{key}: {value}" for key, value in doc.metadata.items() if key != "source_index")
+        # Each result is the meal text followed by its nutritions (pre-rendered once by the meals table)
+        final_results = [self.meals.display[i] for i in reranked]
 
-        # Convert the results to a list of strings. Each string is composed from the 'page_content' field followed by the 'metadata' dictionary.
-        # Do not include the 'source_index' field from the metadata dictionary
-        final_results = []
-        for doc in reranked:
-            #doc.metadata.pop("source_index", None)
-            nutritions = ", ".join(f"{value} {key}" for key, value in doc.metadata.items() if key in 
-                                   ['calories',  'total_fat', 'saturated_fat', 'cholesterol', 'sodium', 'vitamin_b12',
-                                    'vitamin_c', 'vitamin_d', 'vitamin_e', 'protein', 'fiber', 'sugars'])
-            final_results.append(f"{doc.page_content} - with {nutritions}")
-
-        logger.info(f"Ending 'invoke' with {len(final_results)} results")
+        logger.info(f"Ending search with {len(final_results)} results (embedding cache: {self.embedding_cache_stats()}, "
+                    f"pair score cache: {self.pair_score_cache.stats()})")
 
         # log the final results
         for result in final_results:
@@ -117,34 +419,65 @@ class HybridSearch():
 
         return final_results
 
+    def score_candidates(self, query: str, meal_ids: list[int]) -> list[float]:
+        """Cross-encoder scores of the meals for the query - only the pairs missing from the cache are scored
+           (batched with the concurrent queries)"""
+        query_hash = hashlib.sha1(normalize_text(query).encode()).hexdigest()
+        scores = {meal_id: self.pair_score_cache.get((query_hash, meal_id)) for meal_id in meal_ids}
+
+        missing = [meal_id for meal_id, score in scores.items() if score is None]
+        if missing:
+            new_scores = self.rerank_batcher.submit((query, [self.meals.texts[i] for i in missing]))
+            for meal_id, score in zip(missing, new_scores):
+                scores[meal_id] = score
+                self.pair_score_cache.put((query_hash, meal_id), score)
+
+        return [scores[meal_id] for meal_id in meal_ids]
+
+    def rerank(self, query: str, meal_ids: list[int]) -> list[int]:
+        """All the meals, by cross-encoder score"""
+        scores = self.score_candidates(query, meal_ids)
+        return [c for _, c in sorted(zip(scores, meal_ids), key=lambda x: x[0], reverse=True)]
+
+    def adaptive_rerank(self, query: str, bm25_results: list[int], vector_store_results: list[int],
+                        fused_scores: dict[int, float], final_results: int) -> list[int]:
+        """Rerank only as much as needed:
+           - both retrievers agree on the top results - the fused order is kept, the cross-encoder is skipped
+           - otherwise the candidates are scored in fused order, 'final_results' at a time, until a step no longer
+             changes the top results (the candidates left behind rank low in both retrievers)"""
+        hybrid_results = list(fused_scores)
+        if len(hybrid_results) <= final_results:
+            return self.rerank(query, hybrid_results)
+
+        if (len(bm25_results) >= final_results and len(vector_store_results) >= final_results
+                and set(bm25_results[:final_results]) == set(vector_store_results[:final_results])):
+            logger.info(f"Reranking skipped - the retrievers agree on the top {final_results} results")
+            return hybrid_results[:final_results]
+
+        step = final_results
+        scores = {}
+        top = []
+        for start in range(0, len(hybrid_results), step):
+            batch = hybrid_results[start:start + step]
+            scores.update(zip(batch, self.score_candidates(query, batch)))
+            previous, top = top, sorted(scores, key=lambda meal_id: scores[meal_id], reverse=True)[:final_results]
+            if start and top == previous:
+                break
+
+        logger.info(f"Reranked {len(scores)}/{len(hybrid_results)} candidates")
+        return top
+
     def print_results(self, bm25_results, vector_store_results, hybrid_results, reranked):
-        print("\n🔹 BM25 Results:")
-        for doc in bm25_results:
-            source_index = doc.metadata.get("source_index")
-            calories = doc.metadata.get("calories", "N/A")
-            print(f"DB index: {source_index}, Document: {doc.page_content}, Calories: {calories}")
-
-        print("\n🔹 Semantic Embedding Results:")
-        for doc in vector_store_results:
-            source_index = doc.metadata.get("source_index")
-            calories = doc.metadata.get("calories", "N/A")
-            print(f"DB index: {source_index}, Document: {doc.page_content}, Calories: {calories}")
-
-        print("\n🔹 Hybrid Results:")
-        for doc in hybrid_results:
-            source_index = doc.metadata.get("source_index")
-            calories = doc.metadata.get("calories", "N/A")
-            print(f"DB index: {source_index}, Document: {doc.page_content}, Calories: {calories}")
-
-        print("\n🔹 Reranked Results:")
-        for doc in reranked:
-            source_index = doc.metadata.get("source_index")
-            calories = doc.metadata.get("calories", "N/A")
-            print(f"DB index: {source_index}, Document: {doc.page_content}, Calories: {calories}")
+        for title, meal_ids in [("BM25 Results", bm25_results), ("Semantic Embedding Results", vector_store_results),
+                                ("Hybrid Results", hybrid_results), ("Reranked Results", reranked)]:
+            print(f"\n🔹 {title}:")
+            for meal_id in meal_ids:
+                calories = self.meals.value(meal_id, "calories")
+                print(f"DB index: {meal_id}, Document: {self.meals.texts[meal_id]}, Calories: {calories}")
 
         print("\n🔹 Final:")
-        for doc in reranked:
-            print(f"{doc}\n")
+        for meal_id in reranked:
+            print(f"{self.meals.display[meal_id]}\n")
 
 
 if __name__ == "__main__":
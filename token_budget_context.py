@@ -0,0 +1,134 @@
+import functools
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import LLMMessage, UserMessage, AssistantMessage, FunctionExecutionResultMessage, FunctionExecutionResult
+from custom_logger import logger
+
+TIKTOKEN_ENCODING = "o200k_base"  # gpt-oss tokenizer (close enough for the other local models)
+CHARS_PER_TOKEN = 4               # Estimation used when tiktoken (or its encoding file) is not available
+MESSAGE_OVERHEAD_TOKENS = 4       # Role and separator tokens of each message in the chat template
+
+KEEP_RECENT_TURNS = 2             # User turns (and everything after them) always kept verbatim
+OLD_TOOL_RESULT_TOKENS = 256      # Old tool results are truncated to this size
+COMPACTION_TARGET = 0.75          # When over budget, drop old turns until the history is under this fraction of it
+
+
+@functools.cache
+def get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken is not available ({e}), estimating tokens as {CHARS_PER_TOKEN} characters each")
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Keep the start of the text, up to 'max_tokens'"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    head = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) if encoding else text[:max_tokens * CHARS_PER_TOKEN]
+    return f"{head}\n... [truncated - an older tool result, call the tool again if needed]"
+
+
+def message_text(message: LLMMessage) -> str:
+    """The text of a message as sent to the model (tool calls and results included)"""
+    if isinstance(message.content, str):
+        return message.content
+    if isinstance(message, FunctionExecutionResultMessage):
+        return "\n".join(result.content for result in message.content)
+    if isinstance(message, AssistantMessage):  # Tool calls
+        return "\n".join(f"{call.name}({call.arguments})" for call in message.content)
+    return "\n".join(part for part in message.content if isinstance(part, str))  # Multimodal user message (images not counted)
+
+
+def message_tokens(message: LLMMessage) -> int:
+    return count_tokens(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+
+
+class TokenBudgetChatCompletionContext(ChatCompletionContext):
+    """Model context holding the whole history, but sending the model only what fits in a token budget.
+
+       - The recent turns ('keep_recent_turns' user turns and all that follows them) are kept verbatim.
+       - Once the history is over budget, the tool results of all the older turns are truncated to
+         'old_tool_result_tokens'.
+       - If still over budget, the oldest turns are dropped (whole turns, so a tool result never loses its call) until
+         the history is under 'compaction_target' of the budget.
+       Under budget nothing is changed. The compaction and drop points only move forward, so the prompt prefix changes
+       only when the budget is exceeded and stays the same for the next turns - the model server can keep reusing
+       its KV-cache.
+
+       'token_budget' is for the history only - the system message and the tool schemas are accounted by the caller.
+    """
+
+    def __init__(self, token_budget: int, keep_recent_turns: int = KEEP_RECENT_TURNS,
+                 old_tool_result_tokens: int = OLD_TOOL_RESULT_TOKENS, compaction_target: float = COMPACTION_TARGET,
+                 initial_messages: list[LLMMessage] | None = None):
+        super().__init__(initial_messages)
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.old_tool_result_tokens = old_tool_result_tokens
+        self.compaction_target = compaction_target
+        self.first_turn = 0  # Turns before it are not sent anymore
+        self.compacted_turns = 0  # Turns before it are sent with truncated tool results
+
+    def compact(self, message: LLMMessage) -> LLMMessage:
+        if not isinstance(message, FunctionExecutionResultMessage):
+            return message
+        results = [FunctionExecutionResult(content=truncate_tokens(result.content, self.old_tool_result_tokens),
+                                           name=result.name, call_id=result.call_id, is_error=result.is_error)
+                   for result in message.content]
+        return FunctionExecutionResultMessage(content=results)
+
+    def split_turns(self) -> list[list[LLMMessage]]:
+        """Group the messages into turns, each starting with a user message"""
+        turns = []
+        for message in self._messages:
+            if isinstance(message, UserMessage) or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    async def get_messages(self) -> list[LLMMessage]:
+        turns = self.split_turns()
+        self.first_turn = min(self.first_turn, len(turns))
+        self.compacted_turns = min(self.compacted_turns, len(turns))
+        recent_start = max(0, len(turns) - self.keep_recent_turns)
+
+        turn_tokens = [sum(message_tokens(message) for message in turn) for turn in turns]
+        compacted = lambda t: [self.compact(message) for message in turns[t]]
+        for t in range(self.compacted_turns):
+            turns[t] = compacted(t)
+            turn_tokens[t] = sum(message_tokens(message) for message in turns[t])
+
+        if sum(turn_tokens[self.first_turn:]) > self.token_budget:
+            for t in range(self.compacted_turns, recent_start):
+                turns[t] = compacted(t)
+                turn_tokens[t] = sum(message_tokens(message) for message in turns[t])
+            self.compacted_turns = max(self.compacted_turns, recent_start)
+
+            target = self.token_budget * self.compaction_target
+            while self.first_turn < recent_start and sum(turn_tokens[self.first_turn:]) > target:
+                self.first_turn += 1
+            logger.info(f"Model context compacted - sending turns {self.first_turn}..{len(turns) - 1}, "
+                        f"{sum(turn_tokens[self.first_turn:])}/{self.token_budget} tokens")
+
+        return [message for turn in turns[self.first_turn:] for message in turn]
+
+    async def clear(self) -> None:
+        await super().clear()
+        self.first_turn = 0
+        self.compacted_turns = 0
+
+    async def load_state(self, state) -> None:
+        await super().load_state(state)
+        self.first_turn = 0
+        self.compacted_turns = 0